@@ -0,0 +1,170 @@
+import dataclasses
+
+from fhirmodels.fhir_package import FhirPackage, FhirPackageLoader
+
+import resource_map
+import profile_map
+import extension_registry
+import fhir_types
+import terminology
+import profiling
+import main
+
+
+@dataclasses.dataclass
+class BatchIssue:
+    resource_index: int
+    path: str
+    message: str
+
+
+@dataclasses.dataclass
+class PrimitiveColumn:
+    fhir_type: str
+    values: list = dataclasses.field(default_factory=list)
+    # (resource index, resource path) of every value, in column order
+    owners: list[tuple[int, str]] = dataclasses.field(default_factory=list)
+
+
+class BatchValidator:
+    """Validates many resources, checking primitive values column by column.
+
+    Primitive values of all resources are grouped into one column per FHIR
+    type, so each type pattern is applied in a single pass over the batch
+    instead of once per element per resource.
+    """
+
+    def __init__(
+        self,
+        package: FhirPackage,
+        registry: extension_registry.ExtensionRegistry | None = None,
+        terminology_store: terminology.CachedTerminology | None = None,
+    ):
+        self.package = package
+        self.registry = registry or extension_registry.ExtensionRegistry(package)
+        self.terminology_store = (
+            terminology_store or terminology.TerminologyStore.from_package(package)
+        )
+        self._profile_maps: dict[str, profile_map.ProfileMap] = {}
+
+    def get_profile_map(self, profile: dict) -> profile_map.ProfileMap:
+        key = profile.get("url") or profile["id"]
+        if key not in self._profile_maps:
+            builder = profile_map.ProfileMapBuilder(package=self.package)
+            self._profile_maps[key] = builder.build_from_profile(profile)
+        return self._profile_maps[key]
+
+    def profile_map_for(self, resource_type: str) -> profile_map.ProfileMap:
+        profile = main.try_get_profile({"resourceType": resource_type}, self.package)
+        if not profile:
+            raise Exception("No profile found for resource")
+        return self.get_profile_map(profile)
+
+    def validate(
+        self,
+        resources: list[dict],
+        profile: dict | None = None,
+        profiler: profiling.Profiler | None = None,
+    ) -> list[list[BatchIssue]]:
+        issues: list[list[BatchIssue]] = [[] for _ in resources]
+        columns: dict[str, PrimitiveColumn] = {}
+
+        for i, resource in enumerate(resources):
+            resource_profile = profile or main.try_get_profile(resource, self.package)
+            if not resource_profile:
+                issues[i].append(BatchIssue(i, "", "No profile found for resource"))
+                continue
+
+            if profiler:
+                profiler.resource_type = resource["resourceType"]
+            rm = resource_map.ResourceMapBuilder().build_from_dict(resource)
+            pm = self.get_profile_map(resource_profile)
+            try:
+                rm, nested = main.split_nested_resources(rm, pm, self.profile_map_for)
+                main.check_structure(rm, pm, profiler)
+                main.check_cardinality(rm, pm, profiler)
+                main.check_coding_bindings(rm, pm, self.terminology_store, profiler)
+                main.check_extensions(rm, self.registry, profiler)
+                # contained resources are rare, so they are checked one by one
+                # instead of through the columns
+                for level in main.levels_up_to(main.ValidationLevel.BINDINGS):
+                    main.check_nested_level(
+                        level, nested, self.terminology_store, self.registry, profiler
+                    )
+            except Exception as e:
+                issues[i].append(BatchIssue(i, "", str(e)))
+                continue
+
+            self.collect_primitives(i, rm, pm, columns)
+
+        for column in columns.values():
+            if profiler:
+                start = profiler.start()
+            invalid = fhir_types.find_invalid_values(column.fhir_type, column.values)
+            if profiler:
+                self.record_column(profiler, column, resources, start)
+            for j in invalid:
+                resource_index, path = column.owners[j]
+                issues[resource_index].append(
+                    BatchIssue(
+                        resource_index,
+                        path,
+                        f"{column.values[j]} is not a valid {column.fhir_type}",
+                    )
+                )
+
+        return issues
+
+    def record_column(
+        self,
+        profiler: profiling.Profiler,
+        column: PrimitiveColumn,
+        resources: list[dict],
+        start: float,
+    ):
+        # a column is checked in one pass, so its time is shared evenly by its values
+        seconds = (profiler.start() - start) / max(len(column.values), 1)
+        rule = f"type:{column.fhir_type}"
+        for resource_index, path in column.owners:
+            profiler.resource_type = resources[resource_index]["resourceType"]
+            profiler.add(main.replace_index(path), rule, seconds)
+
+    def collect_primitives(
+        self,
+        resource_index: int,
+        rm: resource_map.ResourceMap,
+        pm: profile_map.ProfileMap,
+        columns: dict[str, PrimitiveColumn],
+    ):
+        for r_path, r_el in rm.map.items():
+            if not r_el.is_primitive or extension_registry.is_extension_path(r_path):
+                continue
+            p_path = main.replace_index(r_path)
+            # json _<name> keys are not in the profile, their content is checked
+            # by check_extensions
+            if p_path not in pm:
+                continue
+            p_type = pm[p_path].element["type"][0]["code"]
+            if p_type == "http://hl7.org/fhirpath/System.String":
+                p_type = "string"
+            column = columns.get(p_type)
+            if column is None:
+                column = columns[p_type] = PrimitiveColumn(fhir_type=p_type)
+            column.values.append(r_el.value)
+            column.owners.append((resource_index, r_path))
+
+
+def validate_batch(
+    resources: list[dict],
+    version: str | None = "R4",
+    profile: dict | None = None,
+    profiler: profiling.Profiler | None = None,
+) -> list[list[BatchIssue]]:
+    loader = FhirPackageLoader()
+    base_package = loader.load_from_version(fhir_version=version)
+    registry = main.get_extension_registry(base_package, version)
+    terminology_store = main.get_terminology_store(base_package, version)
+    validator = BatchValidator(
+        package=base_package, registry=registry, terminology_store=terminology_store
+    )
+    return validator.validate(resources, profile=profile, profiler=profiler)
@@ -0,0 +1,52 @@
+import io
+import sys
+import json
+import time
+
+from fhirmodels.fhir_package import FhirPackageLoader
+
+import resource_map
+import profile_map
+import utils
+
+CONDITION_JSON_PATH = "./data/condition-1.json"
+CONDITION_XML_PATH = "./data/condition-1.xml"
+PROFILE_PATH = "./profile.json"
+
+
+def time_runs(fn, n: int) -> float:
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return time.perf_counter() - start
+
+
+def bench_json(path: str, n: int) -> float:
+    with open(path, "rb") as f:
+        data = f.read()
+    builder = resource_map.ResourceMapBuilder()
+    return time_runs(lambda: builder.build_from_dict(json.loads(data)), n)
+
+
+def bench_xml(path: str, pm: profile_map.ProfileMap, n: int) -> float:
+    with open(path, "rb") as f:
+        data = f.read()
+    builder = resource_map.ResourceMapBuilder()
+    return time_runs(
+        lambda: builder.build_from_xml(io.BytesIO(data), lambda _: pm), n
+    )
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+    loader = FhirPackageLoader()
+    package = loader.load_from_version(fhir_version="R4")
+    profile = utils.read_json(PROFILE_PATH)
+    pm = profile_map.ProfileMapBuilder(package=package).build_from_profile(profile)
+
+    # both include parsing the document, not only building the map
+    json_seconds = bench_json(CONDITION_JSON_PATH, n)
+    xml_seconds = bench_xml(CONDITION_XML_PATH, pm, n)
+    for name, seconds in (("json", json_seconds), ("xml", xml_seconds)):
+        print(f"{name}: {n / seconds:10.1f} resources/s ({seconds * 1e6 / n:.1f} us each)")
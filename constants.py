@@ -1,5 +1,8 @@
 MAX_RECURSION_DEPTH = 5
 
+# one terminology index per FHIR version
+TERMINOLOGY_DB_PATH = "./terminology-{version}.db"
+
 PRIMITIVE_KIND = "primitive-type"
 COMPLEX_KIND = "complex-type"
 
@@ -74,4 +77,7 @@ COMPLEX_ELEMENT_TYPES = [
     "UsageContext",
 ]
 
+# type of elements that hold a whole resource (contained, Bundle.entry.resource)
+RESOURCE_ELEMENT_TYPE = "Resource"
+
 CONTAINED_ELEMENT_TYPES = ["Resource", "DomainResource", "BackboneElement", "Element"]
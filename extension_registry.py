@@ -0,0 +1,216 @@
+import re
+import dataclasses
+
+from fhirmodels.fhir_package import FhirPackage
+
+import constants as c
+import fhir_types
+
+
+EXTENSION_TYPE = "Extension"
+
+# matches any path that is an extension or lies inside one
+EXTENSION_PATH_PATTERN = re.compile(r"(?:^|\.)(?:extension|modifierExtension)\[\d+\]")
+# splits a direct member of the innermost extension into (extension path, key)
+EXTENSION_MEMBER_PATTERN = re.compile(
+    r"^(.*(?:extension|modifierExtension)\[\d+\])\.([^.\[]+)(?:\[\d+\])?$"
+)
+# keys an extension may have besides value[x] and its _value[x] primitive extension
+EXTENSION_MEMBERS = ("id", "url", "extension")
+# extracts the parent extension path of a nested extension
+NESTED_EXTENSION_PATTERN = re.compile(
+    r"^(.*(?:extension|modifierExtension)\[\d+\])\.extension\[\d+\]$"
+)
+# members of the _<name> object that carries the id and extensions of a json primitive
+PRIMITIVE_EXTENSION_MEMBERS = ("", "id")
+
+
+@dataclasses.dataclass
+class CompiledExtension:
+    url: str
+    # maps the json key of each allowed value[x] choice (e.g. valueString) to its type
+    value_types: dict[str, str]
+    value_min: int
+    children: dict[str, "CompiledExtension"] = dataclasses.field(default_factory=dict)
+    # cardinality as a slice of the parent extension, for nested extensions
+    min: int = 0
+    max: str = "*"
+
+
+def is_extension_path(path: str) -> bool:
+    return bool(EXTENSION_PATH_PATTERN.search(path))
+
+
+def split_primitive_extension(path: str) -> tuple[str, str] | None:
+    # json carries the id and extensions of a primitive in a sibling _<name> key, so
+    # "name[0]._family.id" belongs to ("name[0].family", "id")
+    segments = path.split(".")
+    for i, segment in enumerate(segments):
+        if segment.startswith("_"):
+            owner = ".".join([*segments[:i], segment[1:]])
+            return owner, ".".join(segments[i + 1 :])
+    return None
+
+
+def parent_extension_path(ext_path: str) -> str | None:
+    match = NESTED_EXTENSION_PATTERN.match(ext_path)
+    return match.group(1) if match else None
+
+
+def value_key(type_code: str) -> str:
+    return "value" + type_code[0].upper() + type_code[1:]
+
+
+class ExtensionRegistry:
+    """Index of extension StructureDefinitions by canonical url.
+
+    Definitions are compiled on first lookup and cached, so resolving an
+    extension is a dict lookup regardless of how many are loaded.
+    """
+
+    def __init__(self, package: "FhirPackage | None" = None):
+        self._definitions: dict[str, dict] = {}
+        self._compiled: dict[str, CompiledExtension] = {}
+        if package is not None:
+            for sd in package.structure_definitions:
+                if self.is_extension_definition(sd):
+                    self.add(sd)
+
+    def __contains__(self, url: str):
+        return url in self._definitions
+
+    def __len__(self):
+        return len(self._definitions)
+
+    def add(self, structure_definition: dict):
+        url = structure_definition["url"]
+        self._definitions[url] = structure_definition
+        self._compiled.pop(url, None)
+
+    def get(self, url: str) -> CompiledExtension | None:
+        compiled = self._compiled.get(url)
+        if compiled is None and url in self._definitions:
+            compiled = self.compile(self._definitions[url])
+            self._compiled[url] = compiled
+        return compiled
+
+    def is_extension_definition(self, structure_definition: dict):
+        return (
+            structure_definition.get("type") == EXTENSION_TYPE
+            and structure_definition.get("derivation") == "constraint"
+            and "url" in structure_definition
+        )
+
+    def compile(self, structure_definition: dict) -> CompiledExtension:
+        elements = {
+            element["id"]: element
+            for element in structure_definition.get("snapshot", {}).get("element", [])
+        }
+        return self.compile_elements(
+            structure_definition["url"], elements, EXTENSION_TYPE
+        )
+
+    def compile_elements(
+        self, url: str, elements: dict[str, dict], root_id: str
+    ) -> CompiledExtension:
+        value_types = {}
+        value_min = 0
+        value_element = elements.get(f"{root_id}.value[x]")
+        if value_element and value_element.get("max") != "0":
+            value_min = int(value_element.get("min", 0))
+            for element_type in value_element.get("type", []):
+                value_types[value_key(element_type["code"])] = element_type["code"]
+
+        children = {}
+        slice_prefix = f"{root_id}.extension:"
+        for element_id in elements:
+            if not element_id.startswith(slice_prefix):
+                continue
+            if "." in element_id[len(slice_prefix) :]:
+                continue
+            child_url = elements.get(f"{element_id}.url", {}).get("fixedUri")
+            if not child_url:
+                continue
+            child = self.compile_elements(child_url, elements, element_id)
+            child.min = int(elements[element_id].get("min", 0))
+            child.max = elements[element_id].get("max", "*")
+            children[child_url] = child
+
+        return CompiledExtension(
+            url=url, value_types=value_types, value_min=value_min, children=children
+        )
+
+
+def check_extension_members(ext_path: str, members: dict[str, object]):
+    for key in members:
+        if key in EXTENSION_MEMBERS or key.startswith(("value", "_value")):
+            continue
+        print(f"Extension error: unknown element {key} at {ext_path}")
+        raise Exception(f"Invalid Extension: unknown element {key} at {ext_path}")
+
+
+def check_extension_instance(
+    compiled: CompiledExtension, ext_path: str, members: dict[str, object]
+):
+    # members maps the keys present in the extension instance to their value
+    # (None for complex values)
+    value_keys = [key for key in members if key.startswith("value")]
+    if len(value_keys) > 1:
+        print(f"Extension error: multiple values {value_keys} at {ext_path}")
+        raise Exception(
+            f"Invalid Extension: multiple values {value_keys} at {ext_path}"
+        )
+
+    if not value_keys:
+        if compiled.value_min > 0:
+            print(f"Extension error: missing value for {compiled.url} at {ext_path}")
+            raise Exception(
+                f"Invalid Extension: missing value for {compiled.url} at {ext_path}"
+            )
+        return
+
+    key = value_keys[0]
+    if key not in compiled.value_types:
+        print(f"Extension error: {key} not allowed for {compiled.url} at {ext_path}")
+        raise Exception(
+            f"Invalid Extension: {key} not allowed for {compiled.url} at {ext_path}"
+        )
+
+    value_type = compiled.value_types[key]
+    value = members[key]
+    if value_type in c.PRIMITIVE_ELEMENT_TYPES and value is not None:
+        if not fhir_types.check_primitive_fhir_type(fhir_type=value_type, value=value):
+            print(f"Value domain error: {value} is not a valid {value_type}")
+            raise Exception(
+                f"Invalid Extension: {value!r} at {ext_path} is not a valid {value_type}"
+            )
+
+
+def check_extension_children(
+    compiled: CompiledExtension, ext_path: str, child_urls: list[str]
+):
+    # child_urls are the urls of the nested extensions of the instance at ext_path
+    counts: dict[str, int] = {}
+    for url in child_urls:
+        counts[url] = counts.get(url, 0) + 1
+
+    for url in counts:
+        if url not in compiled.children:
+            print(
+                f"Extension error: unknown extension {url} in {compiled.url} at {ext_path}"
+            )
+            raise Exception(
+                f"Invalid Extension: unknown extension {url} in {compiled.url} at {ext_path}"
+            )
+
+    for url, child in compiled.children.items():
+        count = counts.get(url, 0)
+        if count < child.min or (child.max != "*" and count > int(child.max)):
+            print(
+                f"Extension error: expected {child.min}..{child.max} but found {count} "
+                f"of {url} at {ext_path}"
+            )
+            raise Exception(
+                f"Invalid Extension: expected {child.min}..{child.max} but found {count} "
+                f"of {url} at {ext_path}"
+            )
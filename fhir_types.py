@@ -1,9 +1,46 @@
 import re
 
 
+PATTERNS = {
+    "base64Binary": re.compile(r"(?:[A-Za-z0-9+/]{4})*(?:[A-Za-z0-9+/]{2}==|[A-Za-z0-9+/]{3}=)?"),
+    "canonical": re.compile(r"\S*"),
+    "code": re.compile(r"[^\s]+( [^\s]+)*"),
+    "date": re.compile(r"([0-9]{4}(-[0-9]{2}(-[0-9]{2})?)?)?"),
+    "dateTime": re.compile(r"([0-9]{4}(-[0-9]{2}(-[0-9]{2}(T([01][0-9]|2[0-3]):[0-5][0-9]:([0-5][0-9]|60)(\.[0-9]{1,9})?)?)?)?(Z|(\+|-)((0[0-9]|1[0-3]):[0-5][0-9]|14:00)?)?)?"),
+    "decimal": re.compile(r"-?(0|[1-9][0-9]{0,17})(\.[0-9]{1,17})?([eE][+-]?[0-9]{1,9})?"),
+    "id": re.compile(r"[A-Za-z0-9\-\.]{1,64}"),
+    "instant": re.compile(r"([0-9]{4}-(0[1-9]|1[0-2])-(0[1-9]|[1-2][0-9]|3[0-1])T([01][0-9]|2[0-3]):[0-5][0-9]:([0-5][0-9]|60)(\.[0-9]{1,9})?(Z|(\+|-)((0[0-9]|1[0-3]):[0-5][0-9]|14:00)))"),
+    "integer": re.compile(r"[0]|[-+]?[1-9][0-9]*"),
+    "integer64": re.compile(r"[0]|[-+]?[1-9][0-9]*"),
+    "markdown": re.compile(r"^[\s\S]+$"),
+    "oid": re.compile(r"urn:oid:[0-2](\.(0|[1-9][0-9]*))+"),
+    "positiveInt": re.compile(r"[1-9][0-9]*"),
+    "time": re.compile(r"([01][0-9]|2[0-3]):[0-5][0-9]:([0-5][0-9]|60)(\.[0-9]{1,9})?"),
+    "unsignedInt": re.compile(r"[0]|([1-9][0-9]*)"),
+    "uri": re.compile(r"\S*"),
+    "url": re.compile(r"\S*"),
+    "uuid": re.compile(r"urn:uuid:[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"),
+}
+
+NUMBER_TYPES = ("decimal", "integer", "integer64", "positiveInt", "unsignedInt")
+
+
+def to_lexical(fhir_type: str, value) -> str | None:
+    # json carries booleans and numbers natively, the patterns match their lexical
+    # form; returns None if the json type cannot hold a value of fhir_type
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        if fhir_type == "boolean":
+            return "true" if value else "false"
+        return None
+    if isinstance(value, (int, float)) and fhir_type in NUMBER_TYPES:
+        return str(value)
+    return None
+
+
 def is_base64Binary(value: str) -> bool:
-    pattern = r"(?:[A-Za-z0-9+/]{4})*(?:[A-Za-z0-9+/]{2}==|[A-Za-z0-9+/]{3}=)?"
-    return bool(re.fullmatch(pattern, value))
+    return bool(PATTERNS["base64Binary"].fullmatch(value))
 
 
 def is_boolean(value: str) -> bool:
@@ -11,58 +48,47 @@ def is_boolean(value: str) -> bool:
 
 
 def is_canonical(value: str) -> bool:
-    pattern = r"\S*"
-    return bool(re.fullmatch(pattern, value))
+    return bool(PATTERNS["canonical"].fullmatch(value))
 
 
 def is_code(value: str) -> bool:
-    pattern = r"[^\s]+( [^\s]+)*"
-    return bool(re.fullmatch(pattern, value))
+    return bool(PATTERNS["code"].fullmatch(value))
 
 
 def is_date(value: str) -> bool:
-    pattern = r"([0-9]{4}(-[0-9]{2}(-[0-9]{2})?)?)?"
-    return bool(re.fullmatch(pattern, value))
+    return bool(PATTERNS["date"].fullmatch(value))
 
 
 def is_dateTime(value: str) -> bool:
-    pattern = r"([0-9]{4}(-[0-9]{2}(-[0-9]{2}(T([01][0-9]|2[0-3]):[0-5][0-9]:([0-5][0-9]|60)(\.[0-9]{1,9})?)?)?)?(Z|(\+|-)((0[0-9]|1[0-3]):[0-5][0-9]|14:00)?)?)?"
-    return bool(re.fullmatch(pattern, value))
+    return bool(PATTERNS["dateTime"].fullmatch(value))
 
 
 def is_decimal(value: str) -> bool:
-    pattern = r"-?(0|[1-9][0-9]{0,17})(\.[0-9]{1,17})?([eE][+-]?[0-9]{1,9})?"
-    return bool(re.fullmatch(pattern, value))
+    return bool(PATTERNS["decimal"].fullmatch(value))
 
 
 def is_id(value: str) -> bool:
-    pattern = r"[A-Za-z0-9\-\.]{1,64}"
-    return bool(re.fullmatch(pattern, value))
+    return bool(PATTERNS["id"].fullmatch(value))
 
 
 def is_instant(value: str) -> bool:
-    pattern = r"([0-9]{4}-(0[1-9]|1[0-2])-(0[1-9]|[1-2][0-9]|3[0-1])T([01][0-9]|2[0-3]):[0-5][0-9]:([0-5][0-9]|60)(\.[0-9]{1,9})?(Z|(\+|-)((0[0-9]|1[0-3]):[0-5][0-9]|14:00)))"
-    return bool(re.fullmatch(pattern, value))
+    return bool(PATTERNS["instant"].fullmatch(value))
 
 
 def is_integer(value: str) -> bool:
-    pattern = r"[0]|[-+]?[1-9][0-9]*"
-    return bool(re.fullmatch(pattern, value))
+    return bool(PATTERNS["integer"].fullmatch(value))
 
 
 def is_integer64(value: str) -> bool:
-    pattern = r"[0]|[-+]?[1-9][0-9]*"
-    return bool(re.fullmatch(pattern, value))
+    return bool(PATTERNS["integer64"].fullmatch(value))
 
 
 def is_markdown(value: str) -> bool:
-    pattern = r"^[\s\S]+$"
-    return bool(re.fullmatch(pattern, value))
+    return bool(PATTERNS["markdown"].fullmatch(value))
 
 
 def is_oid(value: str) -> bool:
-    pattern = r"urn:oid:[0-2](\.(0|[1-9][0-9]*))+"
-    return bool(re.fullmatch(pattern, value))
+    return bool(PATTERNS["oid"].fullmatch(value))
 
 
 def is_string(value: str) -> bool:
@@ -70,36 +96,33 @@ def is_string(value: str) -> bool:
 
 
 def is_positiveInt(value: str) -> bool:
-    pattern = r"[1-9][0-9]*"
-    return bool(re.fullmatch(pattern, value))
+    return bool(PATTERNS["positiveInt"].fullmatch(value))
 
 
 def is_time(value: str) -> bool:
-    pattern = r"([01][0-9]|2[0-3]):[0-5][0-9]:([0-5][0-9]|60)(\.[0-9]{1,9})?"
-    return bool(re.fullmatch(pattern, value))
+    return bool(PATTERNS["time"].fullmatch(value))
 
 
 def is_unsignedInt(value: str) -> bool:
-    pattern = r"[0]|([1-9][0-9]*)"
-    return bool(re.fullmatch(pattern, value))
+    return bool(PATTERNS["unsignedInt"].fullmatch(value))
 
 
 def is_uri(value: str) -> bool:
-    pattern = r"\S*"
-    return bool(re.fullmatch(pattern, value))
+    return bool(PATTERNS["uri"].fullmatch(value))
 
 
 def is_url(value: str) -> bool:
-    pattern = r"\S*"
-    return bool(re.fullmatch(pattern, value))
+    return bool(PATTERNS["url"].fullmatch(value))
 
 
 def is_uuid(value: str) -> bool:
-    pattern = r"urn:uuid:[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
-    return bool(re.fullmatch(pattern, value))
+    return bool(PATTERNS["uuid"].fullmatch(value))
 
 
 def check_primitive_fhir_type(fhir_type: str, value):
+    value = to_lexical(fhir_type, value)
+    if value is None:
+        return False
     if fhir_type == "base64Binary":
         return is_base64Binary(value)
     elif fhir_type == "boolean":
@@ -144,3 +167,25 @@ def check_primitive_fhir_type(fhir_type: str, value):
         return True
     else:
         raise ValueError(f"Unknown FHIR type: {fhir_type}")
+
+
+def find_invalid_values(fhir_type: str, values: list) -> list[int]:
+    # validate a column of values of the same type, returning the failing indices;
+    # repeated values (codes, dates in bulk exports) are only checked once
+    pattern = PATTERNS.get(fhir_type)
+    if pattern is not None:
+        check = pattern.fullmatch
+    else:
+        check = lambda value: check_primitive_fhir_type(fhir_type, value)
+
+    results = {}
+    invalid = []
+    for i, value in enumerate(values):
+        # keyed by type too, as True == 1 in a dict
+        key = (type(value), value)
+        if key not in results:
+            lexical = to_lexical(fhir_type, value)
+            results[key] = lexical is not None and bool(check(lexical))
+        if not results[key]:
+            invalid.append(i)
+    return invalid
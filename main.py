@@ -10,14 +10,22 @@
 # Business Rules: Business rules are made outside the specification, such as checking for duplicates, checking that references resolve, checking that a user is authorized to do what they want to do, etc.
 
 import re
+import enum
 import json
+import time
+import dataclasses
+from typing import Callable, Iterator
 
 from fhirmodels.fhir_package import FhirPackage, FhirPackageLoader
 
 import resource_map
 import profile_map
+import extension_registry
+import terminology
+import profiling
 import fhir_types
 import utils
+import constants as c
 
 
 def replace_index(path: str) -> str:
@@ -39,46 +47,187 @@ def check_valid_json(input):
         raise Exception("Invalid JSON")
 
 
-def check_structure(rm: resource_map.ResourceMap, pm: profile_map.ProfileMap):
+class ValidationLevel(enum.IntEnum):
+    STRUCTURE = 1
+    CARDINALITY = 2
+    TYPES = 3
+    BINDINGS = 4
+    INVARIANTS = 5
+
+
+@dataclasses.dataclass
+class ValidationBudget:
+    # a level that has started always runs to completion; levels that would start
+    # after the budget is spent are deferred instead
+    max_seconds: float | None = None
+    # every level visits each element of the resource once
+    max_elements: int | None = None
+
+
+@dataclasses.dataclass
+class NestedResource:
+    # a contained or Bundle entry resource, with paths relative to path
+    path: str
+    resource_type: str
+    rm: resource_map.ResourceMap
+    pm: profile_map.ProfileMap
+
+
+@dataclasses.dataclass
+class ValidationContext:
+    package: FhirPackage
+    registry: extension_registry.ExtensionRegistry
+    terminology_store: terminology.CachedTerminology | None
+
+
+@dataclasses.dataclass
+class ValidationResult:
+    levels_run: list[ValidationLevel] = dataclasses.field(default_factory=list)
+    # levels skipped because the budget ran out, to be validated later
+    deferred_levels: list[ValidationLevel] = dataclasses.field(default_factory=list)
+    issues: list[str] = dataclasses.field(default_factory=list)
+    rm: resource_map.ResourceMap | None = None
+    pm: profile_map.ProfileMap | None = None
+
+    @property
+    def valid(self) -> bool:
+        return not self.issues
+
+
+def check_structure(
+    rm: resource_map.ResourceMap,
+    pm: profile_map.ProfileMap,
+    profiler: profiling.Profiler | None = None,
+):
     # iterate over all elements in the resource and check if the full_path is in the ProfileTree
     for r_path in rm:
-        r_path = replace_index(r_path)
-        if r_path not in pm:
-            print(f"Element {r_path} not in ProfileTree")
-            raise Exception("Invalid Structure")
+        if profiler:
+            start = profiler.start()
+        check_element_structure(r_path, pm)
+        if profiler:
+            profiler.record(replace_index(r_path), "structure", start)
 
 
-def check_cardinality(rm: resource_map.ResourceMap, pm: profile_map.ProfileMap):
-    # iterate over elements in the resource and check if the cardinality is correct
-    for r_path, r_el in rm.map.items():
-        r_path = replace_index(r_path)
-        r_card = r_el.cardinality
+def check_element_structure(r_path: str, pm: profile_map.ProfileMap):
+    if extension_registry.is_extension_path(r_path):
+        return
+    primitive_extension = extension_registry.split_primitive_extension(r_path)
+    if primitive_extension:
+        # _<name> belongs to <name>; its extensions are checked with the others
+        r_path, member = primitive_extension
+        if member not in extension_registry.PRIMITIVE_EXTENSION_MEMBERS:
+            print(f"Element {member} not allowed in the extensions of {r_path}")
+            raise Exception(
+                f"Invalid Structure: element {member} is not allowed in the "
+                f"extensions of {r_path}"
+            )
+    r_path = replace_index(r_path)
+    if r_path not in pm:
+        print(f"Element {r_path} not in ProfileTree")
+        raise Exception(f"Invalid Structure: element {r_path} is not in the profile")
 
-        p_max = pm[r_path].element.get("max")
+
+def check_cardinality(
+    rm: resource_map.ResourceMap,
+    pm: profile_map.ProfileMap,
+    profiler: profiling.Profiler | None = None,
+):
+    # check the occurrences counted while building the resource map
+    for (parent_path, p_path), r_card in rm.counts.items():
+        # unknown paths (including extension content and json _<name> keys) are
+        # reported elsewhere
+        if p_path not in pm:
+            continue
+        if profiler:
+            start = profiler.start()
+
+        p_max = pm[p_path].element.get("max")
         p_max = int(p_max) if p_max != "*" else "*"
-        p_min = int(pm[r_path].element.get("min"))
+        p_min = int(pm[p_path].element.get("min"))
 
         if r_card < p_min:
             print(
-                f"Cardinality error: expected {p_min} but found {r_card} for element {r_path}"
+                f"Cardinality error: expected {p_min}..{p_max} but found {r_card} for element {p_path}"
+            )
+            raise Exception(
+                f"Invalid Cardinality: expected {p_min}..{p_max} but found {r_card} "
+                f"for element {p_path} in {parent_path or 'the resource'}"
             )
-            raise Exception("Invalid Cardinality")
         elif p_max == "*":
             pass
         elif r_card > p_max:
             print(
-                f"Cardinality error: expected {p_min} but found {r_card} for element {r_path}"
+                f"Cardinality error: expected {p_min}..{p_max} but found {r_card} for element {p_path}"
             )
-            raise Exception("Invalid Cardinality")
+            raise Exception(
+                f"Invalid Cardinality: expected {p_min}..{p_max} but found {r_card} "
+                f"for element {p_path} in {parent_path or 'the resource'}"
+            )
+        if profiler:
+            profiler.record(p_path, "cardinality", start)
+
+    # check that every present element contains its required children
+    instances = [("", "")] + [
+        (r_path, r_el.profile_path)
+        for r_path, r_el in rm.map.items()
+        if not r_el.is_primitive
+    ]
+    for r_path, r_profile_path in instances:
+        if profiler:
+            start = profiler.start()
+        for p_path in pm.required.get(r_profile_path, ()):
+            if (r_path, p_path) not in rm.counts and (
+                r_path,
+                primitive_extension_key(p_path),
+            ) not in rm.counts:
+                p_min = int(pm[p_path].element.get("min"))
+                print(
+                    f"Cardinality error: expected {p_min} but found 0 for element {p_path}"
+                )
+                raise Exception(
+                    f"Invalid Cardinality: expected {p_min} but found 0 "
+                    f"for element {p_path} in {r_path or 'the resource'}"
+                )
+        choices = pm.required_choices.get(r_profile_path, {})
+        for choice_path, p_paths in choices.items():
+            if not any(
+                (r_path, p_path) in rm.counts
+                or (r_path, primitive_extension_key(p_path)) in rm.counts
+                for p_path in p_paths
+            ):
+                print(
+                    f"Cardinality error: expected 1 but found 0 for element {choice_path}"
+                )
+                raise Exception(
+                    f"Invalid Cardinality: expected 1 but found 0 "
+                    f"for element {choice_path} in {r_path or 'the resource'}"
+                )
+        if profiler:
+            profiler.record(r_profile_path, "required", start)
+
 
+def primitive_extension_key(p_path: str) -> str:
+    # profile path of the json _<name> key that may stand in for a primitive
+    parent, _, name = p_path.rpartition(".")
+    return f"{parent}._{name}" if parent else f"_{name}"
 
-def check_value_domains(rm: resource_map.ResourceMap, pm: profile_map.ProfileMap):
+
+def check_value_domains(
+    rm: resource_map.ResourceMap,
+    pm: profile_map.ProfileMap,
+    profiler: profiling.Profiler | None = None,
+):
     # iterate over elements in the resource and check if the value domain is correct
     # at the moment only checking primitive types
     for r_path, r_el in rm.map.items():
-        r_path = replace_index(r_path)
-        if r_el.is_primitive:
-            p_el = pm[r_path]
+        if extension_registry.is_extension_path(r_path):
+            continue
+        p_path = replace_index(r_path)
+        # paths missing from the profile are structure errors, reported by that level
+        if r_el.is_primitive and p_path in pm:
+            if profiler:
+                start = profiler.start()
+            p_el = pm[p_path]
             p_type = p_el.element["type"][0]["code"]
             try:
                 res = fhir_types.check_primitive_fhir_type(
@@ -90,32 +239,138 @@ def check_value_domains(rm: resource_map.ResourceMap, pm: profile_map.ProfileMap
                 raise Exception("Invalid Value Domain")
             if not res:
                 print(f"Value domain error: {r_el.value} is not a valid {p_type}")
-                raise Exception("Invalid Value Domain")
+                raise Exception(
+                    f"Invalid Value Domain: {r_el.value!r} at {r_path} is not a valid {p_type}"
+                )
+            if profiler:
+                profiler.record(p_path, f"type:{p_type}", start)
+
+
+def get_required_binding(p_el: profile_map.ProfileMapElement) -> str | None:
+    binding = p_el.element.get("binding")
+    if binding and binding.get("strength") == "required" and binding.get("valueSet"):
+        return utils.remove_after_pipe(binding["valueSet"])
+    return None
 
 
 def check_coding_bindings(
-    rm: resource_map.ResourceMap, pm: profile_map.ProfileMap, package: FhirPackage
+    rm: resource_map.ResourceMap,
+    pm: profile_map.ProfileMap,
+    terminology_store: terminology.CachedTerminology,
+    profiler: profiling.Profiler | None = None,
+):
+    # collect the codes of all bound elements, keyed by value set, so each value set
+    # is checked with one batched lookup. A bound CodeableConcept is valid if any of
+    # its codings is.
+    lookups: dict[str, list[tuple[str, str | None, str]]] = {}
+    # profile path of every code in lookups, to attribute the lookup time
+    lookup_paths: dict[str, list[str]] = {}
+    for r_path, r_el in rm.map.items():
+        if not r_el.is_primitive or extension_registry.is_extension_path(r_path):
+            continue
+        p_path = replace_index(r_path)
+        # paths missing from the profile are structure errors, reported by that level
+        if p_path not in pm:
+            continue
+
+        valueset = get_required_binding(pm[p_path])
+        if valueset:
+            lookups.setdefault(valueset, []).append((r_path, None, r_el.value))
+            lookup_paths.setdefault(valueset, []).append(p_path)
+            continue
+
+        if not p_path.endswith(".code"):
+            continue
+        coding_path = r_path[: -len(".code")]
+        system_el = rm.map.get(f"{coding_path}.system")
+        system = system_el.value if system_el else None
+
+        p_coding_path = p_path[: -len(".code")]
+        valueset = get_required_binding(pm[p_coding_path])
+        if valueset:
+            lookups.setdefault(valueset, []).append((coding_path, system, r_el.value))
+            lookup_paths.setdefault(valueset, []).append(p_path)
+        elif p_coding_path.endswith(".coding[i]"):
+            p_concept_path = p_coding_path[: -len(".coding[i]")]
+            valueset = get_required_binding(pm[p_concept_path])
+            if valueset:
+                concept_path = coding_path[: coding_path.rindex(".coding[")]
+                lookups.setdefault(valueset, []).append((concept_path, system, r_el.value))
+                lookup_paths.setdefault(valueset, []).append(p_path)
+
+    for valueset, codes in lookups.items():
+        if profiler:
+            start = profiler.start()
+        if not terminology_store.has_value_set(valueset):
+            print(f"ValueSet {valueset} not found, skipping")
+            continue
+        results = terminology_store.validate_codes(
+            valueset, [(system, code) for _, system, code in codes]
+        )
+        if profiler:
+            # one batched lookup per value set, shared evenly by its codes
+            seconds = (profiler.start() - start) / len(codes)
+            for p_path in lookup_paths[valueset]:
+                profiler.add(p_path, f"binding:{valueset}", seconds)
+        valid_paths = {path for (path, _, _), valid in zip(codes, results) if valid}
+        for path, _, code in codes:
+            if path not in valid_paths:
+                print(f"Coding binding error: {code} at {path} is not in {valueset}")
+                raise Exception(
+                    f"Invalid Coding Binding: {code} at {path} is not in {valueset}"
+                )
+
+
+def check_extensions(
+    rm: resource_map.ResourceMap,
+    registry: extension_registry.ExtensionRegistry,
+    profiler: profiling.Profiler | None = None,
 ):
-    # iterate over elements in the resource and check if the coding bindings are correct
+    # group the direct members of every extension instance in a single pass
+    instances: dict[str, dict] = {}
     for r_path, r_el in rm.map.items():
-        found = False
-        r_path = replace_index(r_path)
-        p_el = pm[r_path]
-        if "binding" in p_el.element:
-            binding = p_el.element["binding"]
-            if binding["strength"] == "required":
-                valueset = binding["valueSet"]
-                valueset = utils.remove_after_pipe(valueset)
-                for vs in package.value_sets:
-                    if vs["url"] == valueset:
-                        for concept in vs["concept"]:
-                            print(concept)
-                            if concept["code"] == r_el.value:
-                                found = True
-                                break
-                if not found:
-                    print(f"ValueSet {valueset} not found")
-                    raise Exception("Invalid Coding Binding")
+        match = extension_registry.EXTENSION_MEMBER_PATTERN.match(r_path)
+        if match:
+            ext_path, key = match.groups()
+            instances.setdefault(ext_path, {})[key] = r_el.value
+
+    # urls of the nested extensions of each extension instance
+    child_urls: dict[str, list[str]] = {}
+    for ext_path, members in instances.items():
+        parent_path = extension_registry.parent_extension_path(ext_path)
+        if parent_path is not None and members.get("url"):
+            child_urls.setdefault(parent_path, []).append(members["url"])
+
+    # resolve parents before nested extensions, which are slices of their parent
+    resolved: dict[str, extension_registry.CompiledExtension] = {}
+    for ext_path in sorted(instances, key=len):
+        members = instances[ext_path]
+        extension_registry.check_extension_members(ext_path, members)
+        url = members.get("url")
+        if not url:
+            print(f"Extension error: missing url at {ext_path}")
+            raise Exception(f"Invalid Extension: missing url at {ext_path}")
+
+        parent_path = extension_registry.parent_extension_path(ext_path)
+        if parent_path is None:
+            compiled = registry.get(url)
+        elif parent_path in resolved:
+            compiled = resolved[parent_path].children.get(url)
+        else:
+            compiled = None
+
+        if compiled is None:
+            print(f"Extension {url} not found, skipping")
+            continue
+        resolved[ext_path] = compiled
+        if profiler:
+            start = profiler.start()
+        extension_registry.check_extension_instance(compiled, ext_path, members)
+        extension_registry.check_extension_children(
+            compiled, ext_path, child_urls.get(ext_path, [])
+        )
+        if profiler:
+            profiler.record(replace_index(ext_path), f"extension:{url}", start)
 
 
 def check_invariants():
@@ -139,28 +394,452 @@ def try_get_profile(resource: dict, package: FhirPackage) -> dict | None:
     return profile
 
 
+def levels_up_to(level: ValidationLevel) -> list[ValidationLevel]:
+    # each level includes the ones below it; invariants are not checked yet, so they
+    # are never reported as run
+    return [
+        lower
+        for lower in ValidationLevel
+        if lower <= level and lower != ValidationLevel.INVARIANTS
+    ]
+
+
+def select_levels(
+    level: ValidationLevel, levels: list[ValidationLevel] | None
+) -> list[ValidationLevel]:
+    # levels runs exactly the given levels, e.g. the deferred_levels of an earlier
+    # result as a backfill; otherwise every level up to level runs
+    if levels is None:
+        return levels_up_to(level)
+    return sorted(lower for lower in set(levels) if lower != ValidationLevel.INVARIANTS)
+
+
+def get_validation_context(
+    version: str | None,
+    levels: list[ValidationLevel],
+    registry: extension_registry.ExtensionRegistry | None = None,
+    terminology_store: terminology.CachedTerminology | None = None,
+) -> ValidationContext:
+    # the terminology store is only opened when bindings are checked
+    loader = FhirPackageLoader()
+    base_package = loader.load_from_version(fhir_version=version)
+    if registry is None:
+        registry = get_extension_registry(base_package, version)
+    if terminology_store is None and ValidationLevel.BINDINGS in levels:
+        terminology_store = get_terminology_store(base_package, version)
+    return ValidationContext(base_package, registry, terminology_store)
+
+
+def structure_callback(
+    pm_for: Callable[[], profile_map.ProfileMap],
+    profiler: profiling.Profiler | None = None,
+) -> Callable[[resource_map.ResourceMapElement], None]:
+    # checks the structure of every element as soon as it is built. pm_for returns
+    # the profile map of the root, which xml only knows once parsing has started.
+    # Nested resources are checked against their own profile map by run_levels.
+    nested_prefixes: list[str] = []
+
+    def check_built_element(el: resource_map.ResourceMapElement):
+        if el.path.startswith(tuple(nested_prefixes)):
+            return
+        pm = pm_for()
+        if profiler:
+            start = profiler.start()
+        check_element_structure(el.path, pm)
+        if pm.is_resource(el.profile_path):
+            nested_prefixes.append(f"{el.path}.")
+        if profiler:
+            profiler.record(el.profile_path, "structure", start)
+
+    return check_built_element
+
+
 def validate(
     resource: dict,
     version: str | None = "R4",
     profile: dict | None = None,
-):
+    registry: extension_registry.ExtensionRegistry | None = None,
+    terminology_store: terminology.CachedTerminology | None = None,
+    level: ValidationLevel = ValidationLevel.INVARIANTS,
+    fail_fast: bool = False,
+    budget: ValidationBudget | None = None,
+    profiler: profiling.Profiler | None = None,
+    levels: list[ValidationLevel] | None = None,
+) -> ValidationResult:
+    # runs every level up to level, or exactly levels when given; fail_fast checks
+    # the structure while the resource map is built and stops at the first failing
+    # level. Without it, later levels still run after a failure, except after a
+    # structure failure.
+    start = time.perf_counter()
+    levels = select_levels(level, levels)
+
     check_valid_json(resource)
-    loader = FhirPackageLoader()
-    base_package = loader.load_from_version(fhir_version=version)
+    context = get_validation_context(version, levels, registry, terminology_store)
 
     if not profile:
-        profile = try_get_profile(resource=resource, package=base_package)
+        profile = try_get_profile(resource=resource, package=context.package)
         if not profile:
             raise Exception("No profile found for resource")
 
-    rm = resource_map.ResourceMapBuilder().build_from_dict(resource)
-    pm = profile_map.ProfileMapBuilder(package=base_package).build_from_profile(profile)
+    if profiler:
+        profiler.resource_type = resource["resourceType"]
+
+    result = ValidationResult()
+    pm = get_profile_map(context.package, version, profile)
+    result.pm = pm
+
+    on_element = None
+    if fail_fast and ValidationLevel.STRUCTURE in levels:
+        on_element = structure_callback(lambda: pm, profiler)
+    try:
+        rm = resource_map.ResourceMapBuilder().build_from_dict(resource, on_element)
+    except Exception as e:
+        result.levels_run.append(ValidationLevel.STRUCTURE)
+        result.issues.append(str(e))
+        return result
+    result.rm = rm
+
+    run_levels(
+        result,
+        levels,
+        ProfileMapCache(package=context.package, version=version),
+        context.terminology_store,
+        context.registry,
+        fail_fast=fail_fast,
+        budget=budget,
+        start=start,
+        profiler=profiler,
+        structure_checked=on_element is not None,
+    )
+    return result
+
+
+def run_levels(
+    result: ValidationResult,
+    levels: list[ValidationLevel],
+    profile_map_for: Callable[[str], profile_map.ProfileMap],
+    terminology_store: terminology.CachedTerminology | None,
+    registry: extension_registry.ExtensionRegistry,
+    fail_fast: bool = False,
+    budget: ValidationBudget | None = None,
+    start: float | None = None,
+    profiler: profiling.Profiler | None = None,
+    structure_checked: bool = False,
+):
+    # checks result.rm against result.pm level by level, recording issues, the levels
+    # run and the levels deferred by the budget in result. Contained and Bundle entry
+    # resources are checked against the profile map of their type from
+    # profile_map_for; structure_checked means only the outer resource was checked.
+    budget = budget or ValidationBudget()
+    start = start if start is not None else time.perf_counter()
+    try:
+        rm, nested = split_nested_resources(result.rm, result.pm, profile_map_for)
+    except Exception as e:
+        result.levels_run.append(ValidationLevel.STRUCTURE)
+        result.issues.append(str(e))
+        return
+    pm = result.pm
+
+    spent_elements = 0
+    for i, level in enumerate(levels):
+        elapsed = time.perf_counter() - start
+        if (budget.max_seconds is not None and elapsed > budget.max_seconds) or (
+            budget.max_elements is not None
+            and spent_elements + len(result.rm.map) > budget.max_elements
+        ):
+            result.deferred_levels = levels[i:]
+            break
+
+        result.levels_run.append(level)
+        spent_elements += len(result.rm.map)
+        try:
+            if not (structure_checked and level == ValidationLevel.STRUCTURE):
+                check_level(level, rm, pm, terminology_store, registry, profiler)
+            check_nested_level(level, nested, terminology_store, registry, profiler)
+        except Exception as e:
+            result.issues.append(str(e))
+            if fail_fast or level == ValidationLevel.STRUCTURE:
+                break
+
+
+def split_nested_resources(
+    rm: resource_map.ResourceMap,
+    pm: profile_map.ProfileMap,
+    profile_map_for: Callable[[str], profile_map.ProfileMap],
+    prefix: str = "",
+) -> tuple[resource_map.ResourceMap, list[NestedResource]]:
+    # moves the content of every element of type Resource (contained[i],
+    # entry[i].resource) into a resource map of its own, with paths relative to it,
+    # so it can be checked against the profile map of its resource type
+    wrappers: list[str] = []
+    for r_path, r_el in rm.map.items():
+        if r_el.is_primitive or not pm.is_resource(r_el.profile_path):
+            continue
+        if not any(r_path.startswith(f"{wrapper}.") for wrapper in wrappers):
+            wrappers.append(r_path)
+    if not wrappers:
+        return rm, []
+
+    def owner(r_path: str) -> str | None:
+        for wrapper in wrappers:
+            if r_path.startswith(f"{wrapper}."):
+                return wrapper
+        return None
+
+    outer = resource_map.ResourceMap({}, {})
+    inner = {wrapper: resource_map.ResourceMap({}, {}) for wrapper in wrappers}
+    for r_path, r_el in rm.map.items():
+        wrapper = owner(r_path)
+        if wrapper is None:
+            outer.map[r_path] = r_el
+            continue
+        p_prefix = len(rm.map[wrapper].profile_path) + 1
+        inner[wrapper].map[r_path[len(wrapper) + 1 :]] = dataclasses.replace(
+            r_el,
+            path=r_path[len(wrapper) + 1 :],
+            profile_path=r_el.profile_path[p_prefix:],
+        )
+    for (parent_path, p_path), count in rm.counts.items():
+        wrapper = parent_path if parent_path in inner else owner(parent_path)
+        if wrapper is None:
+            outer.counts[(parent_path, p_path)] = count
+            continue
+        p_prefix = len(rm.map[wrapper].profile_path) + 1
+        inner[wrapper].counts[
+            (parent_path[len(wrapper) + 1 :], p_path[p_prefix:])
+        ] = count
+
+    nested = []
+    for wrapper, inner_rm in inner.items():
+        resource_type = inner_rm.map.pop("resourceType", None)
+        inner_rm.counts.pop(("", "resourceType"), None)
+        if resource_type is None:
+            print(f"Missing resourceType at {prefix}{wrapper}")
+            raise Exception(
+                f"Invalid Structure: missing resourceType at {prefix}{wrapper}"
+            )
+        inner_pm = profile_map_for(resource_type.value)
+        inner_rm, deeper = split_nested_resources(
+            inner_rm, inner_pm, profile_map_for, f"{prefix}{wrapper}."
+        )
+        nested.append(
+            NestedResource(f"{prefix}{wrapper}", resource_type.value, inner_rm, inner_pm)
+        )
+        nested.extend(deeper)
+    return outer, nested
+
+
+def check_nested_level(
+    level: ValidationLevel,
+    nested: list[NestedResource],
+    terminology_store: terminology.CachedTerminology | None,
+    registry: extension_registry.ExtensionRegistry,
+    profiler: profiling.Profiler | None = None,
+):
+    for resource in nested:
+        if profiler:
+            outer_type, profiler.resource_type = (
+                profiler.resource_type,
+                resource.resource_type,
+            )
+        try:
+            check_level(
+                level, resource.rm, resource.pm, terminology_store, registry, profiler
+            )
+        except Exception as e:
+            raise Exception(f"{resource.path}: {e}")
+        finally:
+            if profiler:
+                profiler.resource_type = outer_type
+
 
-    check_structure(rm, pm)
-    check_cardinality(rm, pm)
-    check_value_domains(rm, pm)
-    check_coding_bindings(rm, pm, base_package)
-    return rm, pm
+_profile_maps: dict[tuple[str | None, str], profile_map.ProfileMap] = {}
+_extension_registries: dict[str | None, extension_registry.ExtensionRegistry] = {}
+
+
+def get_profile_map(
+    package: FhirPackage, version: str | None, profile: dict
+) -> profile_map.ProfileMap:
+    # profile maps only depend on the profile, so build each one once per process
+    key = (version, profile.get("url") or profile["id"])
+    if key not in _profile_maps:
+        builder = profile_map.ProfileMapBuilder(package=package)
+        _profile_maps[key] = builder.build_from_profile(profile)
+    return _profile_maps[key]
+
+
+def get_extension_registry(
+    package: FhirPackage, version: str | None
+) -> extension_registry.ExtensionRegistry:
+    # indexing scans every StructureDefinition, so do it once per version and keep
+    # the compiled definitions for later calls
+    if version not in _extension_registries:
+        _extension_registries[version] = extension_registry.ExtensionRegistry(
+            package=package
+        )
+    return _extension_registries[version]
+
+
+_terminology_stores: dict[str | None, terminology.TerminologyStore] = {}
+
+
+def get_terminology_store(
+    package: FhirPackage, version: str | None
+) -> terminology.TerminologyStore:
+    # one store per process and version, so its connection and lookup cache are
+    # shared by every validate call
+    if version not in _terminology_stores:
+        _terminology_stores[version] = terminology.TerminologyStore.from_package(
+            package, path=c.TERMINOLOGY_DB_PATH.format(version=version)
+        )
+    return _terminology_stores[version]
+
+
+def validate_xml(
+    source,
+    version: str | None = "R4",
+    profile: dict | None = None,
+    registry: extension_registry.ExtensionRegistry | None = None,
+    terminology_store: terminology.CachedTerminology | None = None,
+    level: ValidationLevel = ValidationLevel.INVARIANTS,
+    fail_fast: bool = False,
+    budget: ValidationBudget | None = None,
+    profiler: profiling.Profiler | None = None,
+    levels: list[ValidationLevel] | None = None,
+) -> ValidationResult:
+    # source is a file path or a binary file object containing a FHIR xml resource;
+    # level, levels, fail_fast and budget work as in validate
+    start = time.perf_counter()
+    levels = select_levels(level, levels)
+    context = get_validation_context(version, levels, registry, terminology_store)
+
+    profile_map_for = ProfileMapCache(
+        package=context.package, version=version, profile=profile
+    )
+    on_element = None
+    if fail_fast and ValidationLevel.STRUCTURE in levels:
+        on_element = structure_callback(lambda: profile_map_for.root, profiler)
+
+    result = ValidationResult()
+    builder = resource_map.ResourceMapBuilder()
+    try:
+        resource_type, rm = builder.build_from_xml_with_type(
+            source, profile_map_for, on_element
+        )
+    except Exception as e:
+        result.pm = profile_map_for.root
+        result.levels_run.append(ValidationLevel.STRUCTURE)
+        result.issues.append(str(e))
+        return result
+    result.rm, result.pm = rm, profile_map_for.root
+
+    if profiler:
+        profiler.resource_type = resource_type
+    run_levels(
+        result,
+        levels,
+        profile_map_for,
+        context.terminology_store,
+        context.registry,
+        fail_fast=fail_fast,
+        budget=budget,
+        start=start,
+        profiler=profiler,
+        structure_checked=on_element is not None,
+    )
+    return result
+
+
+def validate_xml_bundle(
+    source,
+    version: str | None = "R4",
+    registry: extension_registry.ExtensionRegistry | None = None,
+    terminology_store: terminology.CachedTerminology | None = None,
+    level: ValidationLevel = ValidationLevel.INVARIANTS,
+    fail_fast: bool = False,
+    budget: ValidationBudget | None = None,
+    profiler: profiling.Profiler | None = None,
+    levels: list[ValidationLevel] | None = None,
+) -> Iterator[ValidationResult]:
+    # streams the entries of a FHIR xml Bundle, validating one resource at a time;
+    # the budget applies to each entry on its own, and the structure of an entry is
+    # checked once it is parsed
+    levels = select_levels(level, levels)
+    context = get_validation_context(version, levels, registry, terminology_store)
+
+    profile_map_for = ProfileMapCache(package=context.package, version=version)
+    builder = resource_map.ResourceMapBuilder()
+    for resource_type, rm in builder.iter_bundle_entries_from_xml(
+        source, profile_map_for
+    ):
+        result = ValidationResult(rm=rm, pm=profile_map_for(resource_type))
+        if profiler:
+            profiler.resource_type = resource_type
+        run_levels(
+            result,
+            levels,
+            profile_map_for,
+            context.terminology_store,
+            context.registry,
+            fail_fast=fail_fast,
+            budget=budget,
+            profiler=profiler,
+        )
+        yield result
+
+
+class ProfileMapCache:
+    # profile map of each resource type, from the process-wide get_profile_map cache
+    def __init__(
+        self, package: FhirPackage, version: str | None, profile: dict | None = None
+    ):
+        self.package = package
+        self.version = version
+        self.profile = profile
+        self._root_type: str | None = None
+        self._maps: dict[str, profile_map.ProfileMap] = {}
+
+    def __call__(self, resource_type: str) -> profile_map.ProfileMap:
+        if resource_type not in self._maps:
+            # an explicit profile applies to the root only, not to nested resources
+            profile = self.profile if self._root_type is None else None
+            profile = profile or try_get_profile(
+                resource={"resourceType": resource_type}, package=self.package
+            )
+            if not profile:
+                raise Exception("No profile found for resource")
+            self._maps[resource_type] = get_profile_map(
+                self.package, self.version, profile
+            )
+        if self._root_type is None:
+            self._root_type = resource_type
+        return self._maps[resource_type]
+
+    @property
+    def root(self) -> profile_map.ProfileMap | None:
+        # profile map of the first requested type, the root of the document
+        return self._maps.get(self._root_type)
+
+
+def check_level(
+    level: ValidationLevel,
+    rm: resource_map.ResourceMap,
+    pm: profile_map.ProfileMap,
+    terminology_store: terminology.CachedTerminology,
+    registry: extension_registry.ExtensionRegistry,
+    profiler: profiling.Profiler | None = None,
+):
+    if level == ValidationLevel.STRUCTURE:
+        check_structure(rm, pm, profiler)
+    elif level == ValidationLevel.CARDINALITY:
+        check_cardinality(rm, pm, profiler)
+    elif level == ValidationLevel.TYPES:
+        check_value_domains(rm, pm, profiler)
+        check_extensions(rm, registry, profiler)
+    elif level == ValidationLevel.BINDINGS:
+        check_coding_bindings(rm, pm, terminology_store, profiler)
+    elif level == ValidationLevel.INVARIANTS:
+        check_invariants()
 
 
 if __name__ == "__main__":
@@ -13,8 +13,18 @@ class ProfileMapElement:
 
 
 class ProfileMap:
-    def __init__(self, map: dict[str, ProfileMapElement]):
+    def __init__(
+        self,
+        map: dict[str, ProfileMapElement],
+        required: dict[str, list[str]] | None = None,
+        required_choices: dict[str, dict[str, list[str]]] | None = None,
+    ):
         self._map = map
+        # paths with min >= 1, keyed by the profile path of their parent
+        self._required = required or {}
+        # choice elements with min >= 1, keyed by the profile path of their parent,
+        # mapping e.g. "onset[x]" to its typed paths, one of which must be present
+        self._required_choices = required_choices or {}
 
     def __iter__(self):
         return iter(self._map)
@@ -29,6 +39,21 @@ class ProfileMap:
     def map(self):
         return self._map
 
+    @property
+    def required(self):
+        return self._required
+
+    @property
+    def required_choices(self):
+        return self._required_choices
+
+    def is_resource(self, path: str) -> bool:
+        # elements of type Resource hold a whole resource, e.g. contained[i]
+        if path not in self._map:
+            return False
+        element_types = self._map[path].element.get("type", [{}])
+        return element_types[0].get("code") == c.RESOURCE_ELEMENT_TYPE
+
 
 class ProfileMapBuilder:
     def __init__(self, package: "FhirPackage"):
@@ -61,6 +86,12 @@ class ProfileMapBuilder:
                 map[full_path] = ProfileMapElement(
                     is_primitive=True, full_path=full_path, element=element
                 )
+            elif self.is_resource_element(element):
+                # the content is validated against the profile map of its own
+                # resource type, see main.split_nested_resources
+                map[full_path] = ProfileMapElement(
+                    is_primitive=False, full_path=full_path, element=element
+                )
             elif self.is_complex_element(element):
                 map[full_path] = ProfileMapElement(
                     is_primitive=False, full_path=full_path, element=element
@@ -92,14 +123,49 @@ class ProfileMapBuilder:
             for element in profile["snapshot"]["element"]:
                 process(element, "", 0)
 
-        return ProfileMap(map)
+        return ProfileMap(
+            map,
+            required=self.get_required_paths(map),
+            required_choices=self.get_required_choices(map),
+        )
+
+    def get_required_paths(self, map: dict[str, ProfileMapElement]):
+        required = {}
+        for full_path, p_el in map.items():
+            # a required choice element only needs one of its types
+            if self.is_multi_type_string(p_el.element.get("path", "")):
+                continue
+            if int(p_el.element.get("min", 0)) < 1:
+                continue
+            parent_path = full_path.rsplit(".", 1)[0] if "." in full_path else ""
+            required.setdefault(parent_path, []).append(full_path)
+        return required
+
+    def get_required_choices(self, map: dict[str, ProfileMapElement]):
+        # group the typed paths of each required choice element (onsetDateTime,
+        # onsetString, ...) under the choice path (onset[x])
+        required = {}
+        for full_path, p_el in map.items():
+            element_path = p_el.element.get("path", "")
+            if not self.is_multi_type_string(element_path):
+                continue
+            if int(p_el.element.get("min", 0)) < 1:
+                continue
+            parent_path = full_path.rsplit(".", 1)[0] if "." in full_path else ""
+            choice_path = element_path.rsplit(".", 1)[-1]
+            if parent_path:
+                choice_path = f"{parent_path}.{choice_path}"
+            required.setdefault(parent_path, {}).setdefault(choice_path, []).append(
+                full_path
+            )
+        return required
 
     def is_primitive_element(self, element: dict):
         if "type" in element:
             return element["type"][0].get("code") in c.PRIMITIVE_ELEMENT_TYPES
 
     def is_invalid_element(self, element: dict):
-        # ignore extension for now
+        # extension content is validated against the ExtensionRegistry
         if element.get("id", "").startswith("Extension"):
             return True
         if not "type" in element:
@@ -107,6 +173,10 @@ class ProfileMapBuilder:
         if element.get("base", {}).get("path").startswith("Element"):
             return True
 
+    def is_resource_element(self, element: dict):
+        if "type" in element:
+            return element["type"][0].get("code") == c.RESOURCE_ELEMENT_TYPE
+
     def is_contained_element(self, element: dict):
         if "type" in element:
             return element["type"][0].get("code") in c.CONTAINED_ELEMENT_TYPES
@@ -0,0 +1,80 @@
+import time
+import dataclasses
+
+
+@dataclasses.dataclass
+class RuleStats:
+    calls: int = 0
+    seconds: float = 0.0
+
+
+@dataclasses.dataclass
+class HotPath:
+    resource_type: str
+    profile_path: str
+    rule: str
+    calls: int
+    seconds: float
+
+
+class Profiler:
+    """Attributes check time and call counts to (profile path, rule) pairs.
+
+    Pass a Profiler to main.validate or the check_* functions; it is shared
+    across a batch, so stats accumulate over all validated resources.
+    """
+
+    def __init__(self):
+        # set by the caller to the resource type being validated
+        self.resource_type = ""
+        self._stats: dict[tuple[str, str, str], RuleStats] = {}
+
+    def start(self) -> float:
+        return time.perf_counter()
+
+    def record(self, profile_path: str, rule: str, start: float, calls: int = 1):
+        self.add(profile_path, rule, time.perf_counter() - start, calls)
+
+    def add(self, profile_path: str, rule: str, seconds: float, calls: int = 1):
+        key = (self.resource_type, profile_path, rule)
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = RuleStats()
+        stats.calls += calls
+        stats.seconds += seconds
+
+    def hot_paths(self, limit: int | None = None) -> list[HotPath]:
+        paths = [
+            HotPath(resource_type, profile_path, rule, stats.calls, stats.seconds)
+            for (resource_type, profile_path, rule), stats in self._stats.items()
+        ]
+        paths.sort(key=lambda path: path.seconds, reverse=True)
+        return paths[:limit] if limit else paths
+
+    def report(self, limit: int | None = 20) -> str:
+        paths = self.hot_paths(limit)
+        total = sum(stats.seconds for stats in self._stats.values()) or 1
+        lines = [f"{'seconds':>10} {'%':>6} {'calls':>8} {'us/call':>9}  path  rule"]
+        for path in paths:
+            full_path = ".".join(filter(None, (path.resource_type, path.profile_path)))
+            lines.append(
+                f"{path.seconds:10.4f} {path.seconds / total * 100:6.1f} {path.calls:8d} "
+                f"{path.seconds / path.calls * 1e6:9.2f}  "
+                f"{full_path}  {path.rule}"
+            )
+        return "\n".join(lines)
+
+    def collapsed_stacks(self) -> list[str]:
+        # one "frame;frame;... microseconds" line per (path, rule), the input format
+        # of flamegraph.pl and speedscope; path segments become nested frames
+        lines = []
+        for path in self.hot_paths():
+            frames = [path.resource_type or "Resource"]
+            frames += [segment for segment in path.profile_path.split(".") if segment]
+            frames.append(path.rule.replace(";", ","))
+            lines.append(f"{';'.join(frames)} {round(path.seconds * 1e6)}")
+        return lines
+
+    def write_collapsed_stacks(self, path: str):
+        with open(path, "w") as f:
+            f.write("\n".join(self.collapsed_stacks()) + "\n")
@@ -1,16 +1,26 @@
-from typing import Any
+from typing import Any, Callable, Iterator
 from pprint import pprint
+import xml.etree.ElementTree as ET
 
 from fhirmodels.fhir_package import FhirPackage
 import constants as c
 import dataclasses
+from profile_map import ProfileMap
+
+
+FHIR_NS = "{http://hl7.org/fhir}"
+XHTML_NS_URI = "http://www.w3.org/1999/xhtml"
+XHTML_NS = f"{{{XHTML_NS_URI}}}"
+
+# elements that repeat regardless of profile (their content is not in the profile map)
+ALWAYS_ARRAY_ELEMENTS = ("extension", "modifierExtension")
+BUNDLE_ENTRY_RESOURCE = "entry[i].resource"
 
 
 @dataclasses.dataclass
 class ResourceMapElement:
     path: str
     profile_path: str
-    cardinality: int
     is_primitive: bool
     value: str | int | None = None
     value_domain: str | None = None
@@ -20,8 +30,14 @@ class ResourceMapElement:
 
 
 class ResourceMap:
-    def __init__(self, map: dict[str, ResourceMapElement]):
+    def __init__(
+        self,
+        map: dict[str, ResourceMapElement],
+        counts: dict[tuple[str, str], int] | None = None,
+    ):
         self._map = map
+        # number of occurrences per (parent instance path, profile path)
+        self._counts = counts or {}
 
     def __iter__(self):
         return iter(self._map)
@@ -36,20 +52,30 @@ class ResourceMap:
     def map(self):
         return self._map
 
+    @property
+    def counts(self):
+        return self._counts
+
 
 class ResourceMapBuilder:
 
     def __init__(self):
         pass
 
-    def build_from_dict(cls, resource: dict):
+    def build_from_dict(
+        cls,
+        resource: dict,
+        on_element: Callable[[ResourceMapElement], None] | None = None,
+    ):
+        # on_element is called with every element as soon as it is built, so
+        # callers can check it early and abort the build by raising
         _map = {}
+        _counts = {}
 
         def process(
             element: list | dict,
             parent_path: str,
             parent_profile_path: str,
-            cardinality: int = 1,
         ):
             if parent_path == "resourceType":
                 return
@@ -58,33 +84,278 @@ class ResourceMapBuilder:
                     path=parent_path,
                     profile_path=parent_profile_path,
                     value=None,
-                    cardinality=cardinality,
                     is_primitive=False,
                 )
                 _map[parent_path] = el
-                for key, value in element.items():
-                    new_path = f"{parent_path}.{key}" if parent_path else key
-                    process(value, f"{new_path}", f"{parent_profile_path}.{key}")
+                if on_element:
+                    on_element(el)
+                process_children(element, parent_path, parent_profile_path)
             elif isinstance(element, list):
                 for i, value in enumerate(element):
                     new_path = f"{parent_path}[{i}]"
-                    process(
-                        value,
-                        f"{new_path}",
-                        f"{parent_profile_path}[x]",
-                        cardinality=len(element),
-                    )
+                    process(value, f"{new_path}", f"{parent_profile_path}[i]")
             else:
                 el = ResourceMapElement(
                     path=parent_path,
                     profile_path=parent_profile_path,
                     value=element,
                     is_primitive=True,
-                    cardinality=1,
                 )
                 _map[parent_path] = el
+                if on_element:
+                    on_element(el)
+
+        def process_children(element: dict, parent_path: str, parent_profile_path: str):
+            for key, value in element.items():
+                new_path = f"{parent_path}.{key}" if parent_path else key
+                new_profile_path = (
+                    f"{parent_profile_path}.{key}" if parent_profile_path else key
+                )
+                if new_path == "resourceType":
+                    continue
+                if isinstance(value, list):
+                    _counts[(parent_path, f"{new_profile_path}[i]")] = len(value)
+                else:
+                    _counts[(parent_path, new_profile_path)] = 1
+                process(value, new_path, new_profile_path)
+
+        process_children(resource, "", "")
+
+        return ResourceMap(map=_map, counts=_counts)
+
+    def build_from_xml(
+        self,
+        source,
+        profile_map_for: Callable[[str], ProfileMap | None] | None = None,
+    ) -> ResourceMap:
+        # profile_map_for is called with the resource type of the root element and
+        # tells the parser which elements are arrays, as xml does not mark them
+        return self.build_from_xml_with_type(source, profile_map_for)[1]
+
+    def build_from_xml_with_type(
+        self,
+        source,
+        profile_map_for: Callable[[str], ProfileMap | None] | None = None,
+        on_element: Callable[[ResourceMapElement], None] | None = None,
+    ) -> tuple[str, ResourceMap]:
+        # the resource type is the name of the root element; on_element works as in
+        # build_from_dict
+        parser = _XmlResourceMapParser(profile_map_for, on_element=on_element)
+        for resource_type, rm in parser.parse_with_types(source):
+            return resource_type, rm
+
+    def iter_bundle_entries_from_xml(
+        self,
+        source,
+        profile_map_for: Callable[[str], ProfileMap | None] | None = None,
+    ) -> Iterator[tuple[str, ResourceMap]]:
+        # yields (resource type, resource map) per Bundle.entry.resource, discarding
+        # parsed elements as it goes so memory stays bounded by the largest entry;
+        # the Bundle's own elements are not kept
+        parser = _XmlResourceMapParser(profile_map_for, split_bundle_entries=True)
+        yield from parser.parse_with_types(source)
+
+
+@dataclasses.dataclass
+class _XmlFrame:
+    path: str
+    profile_path: str
+    # profile map of the enclosing resource and the profile path within it, which
+    # differ from profile_path inside contained or Bundle entry resources
+    profile_map: ProfileMap | None = None
+    local_path: str = ""
+    child_counts: dict[str, int] = dataclasses.field(default_factory=dict)
+    # elements of type Resource wrap a child named after the resource type
+    is_resource_container: bool = False
+
+
+class _XmlContext:
+    def __init__(
+        self, resource_type: str, profile_map: ProfileMap | None, keep: bool = True
+    ):
+        self.resource_type = resource_type
+        self.map: dict[str, ResourceMapElement] = {}
+        self.counts: dict[tuple[str, str], int] = {}
+        # the outer Bundle of a split stream is only walked, not recorded
+        self.keep = keep
+        self.frames: list[_XmlFrame] = [
+            _XmlFrame(path="", profile_path="", profile_map=profile_map)
+        ]
+
+
+class _XmlResourceMapParser:
+    def __init__(
+        self,
+        profile_map_for: Callable[[str], ProfileMap | None] | None = None,
+        split_bundle_entries: bool = False,
+        on_element: Callable[[ResourceMapElement], None] | None = None,
+    ):
+        self.profile_map_for = profile_map_for
+        self.split_bundle_entries = split_bundle_entries
+        self.on_element = on_element
+
+    def parse(self, source) -> Iterator[ResourceMap]:
+        for _, rm in self.parse_with_types(source):
+            yield rm
+
+    def parse_with_types(self, source) -> Iterator[tuple[str, ResourceMap]]:
+        contexts: list[_XmlContext] = []
+        root = None
+        xhtml_depth = 0
+
+        for event, elem in ET.iterparse(source, events=("start", "end")):
+            if event == "start":
+                if xhtml_depth:
+                    xhtml_depth += 1
+                    continue
+                name = self.local_name(elem.tag)
+
+                if root is None:
+                    root = elem
+                    if self.split_bundle_entries:
+                        if name != "Bundle":
+                            print(f"Root element {name} is not a Bundle")
+                            raise Exception("Invalid Bundle")
+                        contexts.append(
+                            _XmlContext(name, self.get_profile_map(name), keep=False)
+                        )
+                    else:
+                        contexts.append(
+                            _XmlContext(name, self.get_profile_map(name))
+                        )
+                    continue
+
+                ctx = contexts[-1]
+                parent = ctx.frames[-1]
+                if parent.is_resource_container:
+                    if not ctx.keep and parent.local_path == BUNDLE_ENTRY_RESOURCE:
+                        contexts.append(_XmlContext(name, self.get_profile_map(name)))
+                        continue
+                    # inline nested resources the way the json builder sees them
+                    self.add_primitive(
+                        ctx, parent, f"{parent.path}.resourceType", name, "resourceType"
+                    )
+                    ctx.frames.append(
+                        _XmlFrame(
+                            parent.path,
+                            parent.profile_path,
+                            profile_map=self.get_profile_map(name),
+                        )
+                    )
+                    continue
+
+                frame = self.add_element(ctx, parent, name, elem)
+                if elem.tag == XHTML_NS + "div":
+                    xhtml_depth = 1
+                ctx.frames.append(frame)
+
+            else:
+                if xhtml_depth:
+                    xhtml_depth -= 1
+                    if xhtml_depth:
+                        continue
+                    ctx = contexts[-1]
+                    frame = ctx.frames[-1]
+                    if ctx.keep:
+                        self.add(
+                            ctx,
+                            ResourceMapElement(
+                                path=frame.path,
+                                profile_path=frame.profile_path,
+                                value=self.serialize_xhtml(elem),
+                                is_primitive=True,
+                            ),
+                        )
+
+                ctx = contexts[-1]
+                ctx.frames.pop()
+                if not ctx.frames:
+                    contexts.pop()
+                    if ctx.keep:
+                        rm = ResourceMap(map=ctx.map, counts=ctx.counts)
+                        yield ctx.resource_type, rm
+
+                if elem is root:
+                    root.clear()
+                elif len(contexts[0].frames) == 1:
+                    # a direct child of the root is complete, drop everything parsed
+                    root.clear()
+                else:
+                    elem.clear()
+
+    def get_profile_map(self, resource_type: str) -> ProfileMap | None:
+        return self.profile_map_for(resource_type) if self.profile_map_for else None
+
+    def add_element(
+        self, ctx: _XmlContext, parent: _XmlFrame, name: str, elem: ET.Element
+    ) -> _XmlFrame:
+        profile_path = f"{parent.profile_path}.{name}" if parent.profile_path else name
+        local_path = f"{parent.local_path}.{name}" if parent.local_path else name
+        path = f"{parent.path}.{name}" if parent.path else name
+        count = parent.child_counts.get(name, 0) + 1
+        parent.child_counts[name] = count
+
+        if self.is_array(parent.profile_map, local_path, name):
+            profile_path += "[i]"
+            local_path += "[i]"
+            path += f"[{count - 1}]"
+
+        frame = _XmlFrame(
+            path,
+            profile_path,
+            profile_map=parent.profile_map,
+            local_path=local_path,
+            is_resource_container=parent.profile_map is not None
+            and parent.profile_map.is_resource(local_path),
+        )
+        if not ctx.keep:
+            return frame
+
+        ctx.counts[(parent.path, profile_path)] = count
+        value = elem.get("value")
+        self.add(
+            ctx,
+            ResourceMapElement(
+                path=path,
+                profile_path=profile_path,
+                value=value,
+                is_primitive=value is not None,
+            ),
+        )
+        for key, attr_value in elem.attrib.items():
+            if key != "value" and not key.startswith("{"):
+                self.add_primitive(ctx, frame, f"{path}.{key}", attr_value, key)
+        return frame
+
+    def add_primitive(
+        self, ctx: _XmlContext, parent: _XmlFrame, path: str, value: str, key: str
+    ):
+        if not ctx.keep:
+            return
+        profile_path = f"{parent.profile_path}.{key}" if parent.profile_path else key
+        ctx.counts[(parent.path, profile_path)] = 1
+        self.add(
+            ctx,
+            ResourceMapElement(
+                path=path, profile_path=profile_path, value=value, is_primitive=True
+            ),
+        )
+
+    def add(self, ctx: _XmlContext, el: ResourceMapElement):
+        ctx.map[el.path] = el
+        if self.on_element:
+            self.on_element(el)
+
+    def is_array(self, pm: ProfileMap | None, local_path: str, name: str) -> bool:
+        if name in ALWAYS_ARRAY_ELEMENTS:
+            return True
+        return pm is not None and f"{local_path}[i]" in pm
 
-        for key, value in resource.items():
-            process(value, key, key)
+    def local_name(self, tag: str) -> str:
+        return tag.rsplit("}", 1)[-1]
 
-        return ResourceMap(map=_map)
+    def serialize_xhtml(self, elem: ET.Element) -> str:
+        tail, elem.tail = elem.tail, None
+        value = ET.tostring(elem, encoding="unicode", default_namespace=XHTML_NS_URI)
+        elem.tail = tail
+        return value
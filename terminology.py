@@ -0,0 +1,516 @@
+import abc
+import csv
+import json
+import sqlite3
+import argparse
+import threading
+import collections
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from fhirmodels.fhir_package import FhirPackage, FhirPackageLoader
+
+import constants as c
+import utils
+
+# sqlite limits the number of bound parameters per statement
+MAX_BATCH_SIZE = 500
+# seconds to wait for another process that is loading the same database
+LOCK_TIMEOUT = 300
+COMPLETE_CONTENT = "complete"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS code_systems (
+    url TEXT NOT NULL,
+    code TEXT NOT NULL,
+    display TEXT,
+    PRIMARY KEY (url, code)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS code_system_content (
+    url TEXT NOT NULL PRIMARY KEY,
+    -- CodeSystem.content; only "complete" systems list every code
+    content TEXT
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS value_sets (
+    url TEXT NOT NULL PRIMARY KEY,
+    -- 0 when the codes could not all be resolved (filters, unknown code systems)
+    complete INTEGER NOT NULL DEFAULT 1
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS value_set_codes (
+    value_set TEXT NOT NULL,
+    code TEXT NOT NULL,
+    system TEXT NOT NULL,
+    display TEXT,
+    PRIMARY KEY (value_set, code, system)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT NOT NULL PRIMARY KEY,
+    value TEXT
+) WITHOUT ROWID;
+"""
+
+
+class LruCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        if key not in self._data:
+            return default
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+class CachedTerminology(abc.ABC):
+    # validate_codes serves (value set, system, code) results from an LRU cache
+    # and resolves the misses of a call in one batched lookup_codes call
+
+    def __init__(self, cache_size: int):
+        self._cache = LruCache(cache_size)
+
+    def validate_code(self, value_set: str, code: str, system: str | None = None):
+        return self.validate_codes(value_set, [(system, code)])[0]
+
+    def validate_codes(
+        self, value_set: str, codings: list[tuple[str | None, str]]
+    ) -> list[bool]:
+        # codings are (system, code) pairs; a system of None matches any system
+        results = [self._cache.get((value_set, *coding)) for coding in codings]
+        missing = list(
+            dict.fromkeys(
+                coding for coding, result in zip(codings, results) if result is None
+            )
+        )
+        if missing:
+            for coding, valid in zip(missing, self.lookup_codes(value_set, missing)):
+                self._cache.put((value_set, *coding), valid)
+
+        return [
+            result if result is not None else self._cache.get((value_set, *coding))
+            for coding, result in zip(codings, results)
+        ]
+
+    @abc.abstractmethod
+    def has_value_set(self, url: str) -> bool:
+        # False for unknown value sets and value sets whose codes are incomplete;
+        # bindings to them are not checked
+        ...
+
+    @abc.abstractmethod
+    def lookup_codes(
+        self, value_set: str, codings: list[tuple[str | None, str]]
+    ) -> list[bool]:
+        ...
+
+
+class TerminologyStore(CachedTerminology):
+    """On-disk code index of package CodeSystems and ValueSets.
+
+    Codes are stored per value set in sqlite, so a lookup is an index seek
+    and the index can be shared by several validator processes. Lookups go
+    through an in-memory LRU cache of (value set, system, code) results.
+    Value sets that use filters or code systems missing from the store are
+    marked incomplete and reported as unknown by has_value_set.
+    """
+
+    def __init__(self, path: str = ":memory:", cache_size: int = 100_000):
+        super().__init__(cache_size)
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            path, timeout=LOCK_TIMEOUT, check_same_thread=False
+        )
+        self._connection.executescript(SCHEMA)
+
+    @classmethod
+    def from_package(
+        cls, package: FhirPackage, path: str = ":memory:", cache_size: int = 100_000
+    ) -> "TerminologyStore":
+        store = cls(path=path, cache_size=cache_size)
+        if not store.is_loaded(package):
+            store.load_package(package, reload=False)
+        return store
+
+    def is_loaded(self, package: FhirPackage | None = None) -> bool:
+        # the marker is written in the same transaction as the package content, so
+        # an interrupted load leaves the store unloaded rather than partial
+        with self._lock:
+            loaded = self.loaded_package()
+        if package is None:
+            return loaded is not None
+        return loaded == package_key(package)
+
+    def loaded_package(self) -> str | None:
+        row = self._connection.execute(
+            "SELECT value FROM meta WHERE key = 'loaded'"
+        ).fetchone()
+        return row[0] if row else None
+
+    def load_package(self, package: FhirPackage, reload: bool = True):
+        # without reload, the load is skipped when the same package is already in
+        # the store, e.g. loaded by another process while this one waited
+        code_systems = []
+        value_sets = []
+        for resource in [*getattr(package, "code_systems", []), *package.value_sets]:
+            if resource.get("resourceType") == "CodeSystem" or "concept" in resource:
+                code_systems.append(resource)
+            else:
+                value_sets.append(resource)
+
+        with self._lock:
+            # IMMEDIATE takes the write lock up front, so concurrent loaders wait
+            # for each other instead of interleaving
+            self._connection.execute("BEGIN IMMEDIATE")
+            if not reload and self.loaded_package() == package_key(package):
+                self._connection.commit()
+                return
+            try:
+                for table in (
+                    "code_systems",
+                    "code_system_content",
+                    "value_sets",
+                    "value_set_codes",
+                    "meta",
+                ):
+                    self._connection.execute(f"DELETE FROM {table}")
+                # value sets may include whole code systems, so load those first
+                for code_system in code_systems:
+                    self.insert_code_system(code_system)
+                for value_set in self.dependency_order(value_sets):
+                    self.insert_value_set(value_set)
+                self._connection.execute(
+                    "INSERT INTO meta VALUES ('loaded', ?)", (package_key(package),)
+                )
+            except BaseException:
+                self._connection.rollback()
+                raise
+            self._connection.commit()
+
+    def dependency_order(self, value_sets: list[dict]) -> list[dict]:
+        # value sets that include other value sets come after them
+        by_url = {value_set["url"]: value_set for value_set in value_sets}
+        ordered: list[dict] = []
+        visited: set[str] = set()
+        for value_set in value_sets:
+            self.visit_value_set(value_set, by_url, visited, ordered)
+        return ordered
+
+    def visit_value_set(
+        self,
+        value_set: dict,
+        by_url: dict[str, dict],
+        visited: set[str],
+        ordered: list[dict],
+    ):
+        if value_set["url"] in visited:
+            return
+        visited.add(value_set["url"])
+        for include in value_set.get("compose", {}).get("include", []):
+            for included_value_set in include.get("valueSet", []):
+                dependency = by_url.get(utils.remove_after_pipe(included_value_set))
+                if dependency:
+                    self.visit_value_set(dependency, by_url, visited, ordered)
+        ordered.append(value_set)
+
+    def load_code_file(self, path: str, system: str, value_set: str | None = None):
+        # csv file with a code column and an optional display column
+        with open(path, newline="") as f:
+            rows = [
+                (system, row[0], row[1] if len(row) > 1 else None)
+                for row in csv.reader(f)
+                if row
+            ]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO code_systems VALUES (?, ?, ?)", rows
+            )
+            # the file lists every code of the system
+            self._connection.execute(
+                "INSERT OR REPLACE INTO code_system_content VALUES (?, ?)",
+                (system, COMPLETE_CONTENT),
+            )
+            if value_set:
+                # the file lists every code, so the value set is complete
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO value_sets VALUES (?, 1)", (value_set,)
+                )
+                self.insert_value_set_codes(
+                    value_set, [(code, system, display) for system, code, display in rows]
+                )
+
+    def add_code_system(self, code_system: dict):
+        with self._lock, self._connection:
+            self.insert_code_system(code_system)
+
+    def add_value_set(self, value_set: dict):
+        # value sets it includes must be added first, otherwise it is incomplete
+        with self._lock, self._connection:
+            self.insert_value_set(value_set)
+
+    def insert_code_system(self, code_system: dict):
+        url = code_system["url"]
+        concepts = list(self.flatten_concepts(code_system.get("concept", [])))
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO code_systems VALUES (?, ?, ?)",
+            [(url, code, display) for code, display in concepts],
+        )
+        self._connection.execute(
+            "INSERT OR REPLACE INTO code_system_content VALUES (?, ?)",
+            (url, code_system.get("content")),
+        )
+        # the implicit value set of a code system contains all its codes
+        if code_system.get("valueSet"):
+            value_set = utils.remove_after_pipe(code_system["valueSet"])
+            self.insert_value_set_codes(
+                value_set, [(code, url, display) for code, display in concepts]
+            )
+            self.check_code_system_content(value_set, url)
+
+    def insert_value_set(self, value_set: dict):
+        url = value_set["url"]
+        self._connection.execute(
+            "INSERT OR REPLACE INTO value_sets VALUES (?, 1)", (url,)
+        )
+        if "expansion" in value_set:
+            rows = [
+                (code, system, display)
+                for system, code, display in self.flatten_contains(
+                    value_set["expansion"].get("contains", [])
+                )
+            ]
+            self.insert_value_set_codes(url, rows)
+            return
+
+        compose = value_set.get("compose", {})
+        for include in compose.get("include", []):
+            self.include_codes(url, include)
+        for exclude in compose.get("exclude", []):
+            if "concept" not in exclude:
+                self.mark_incomplete(url, "only concept excludes are supported")
+                continue
+            system = exclude.get("system")
+            for concept in exclude["concept"]:
+                self._connection.execute(
+                    "DELETE FROM value_set_codes WHERE value_set = ? AND code = ? AND system = ?",
+                    (url, concept["code"], system),
+                )
+
+    def include_codes(self, url: str, include: dict):
+        system = include.get("system")
+        if "concept" in include:
+            self.insert_value_set_codes(
+                url,
+                [
+                    (concept["code"], system, concept.get("display"))
+                    for concept in include["concept"]
+                ],
+            )
+        elif "filter" in include:
+            self.mark_incomplete(url, "filters are not supported")
+        elif system:
+            self.check_code_system_content(url, system)
+            self._connection.execute(
+                "INSERT OR REPLACE INTO value_set_codes "
+                "SELECT ?, code, url, display FROM code_systems WHERE url = ?",
+                (url, system),
+            )
+        for included_value_set in include.get("valueSet", []):
+            included_url = utils.remove_after_pipe(included_value_set)
+            row = self._connection.execute(
+                "SELECT complete FROM value_sets WHERE url = ?", (included_url,)
+            ).fetchone()
+            if not row or not row[0]:
+                self.mark_incomplete(url, f"included value set {included_url} is incomplete")
+            self._connection.execute(
+                "INSERT OR REPLACE INTO value_set_codes "
+                "SELECT ?, code, system, display FROM value_set_codes WHERE value_set = ?",
+                (url, included_url),
+            )
+
+    def check_code_system_content(self, url: str, system: str):
+        # a value set with all codes of a system is only complete if the store has
+        # all of them, which fragment, example and not-present systems do not list
+        row = self._connection.execute(
+            "SELECT content FROM code_system_content WHERE url = ?", (system,)
+        ).fetchone()
+        if row is None:
+            self.mark_incomplete(url, f"code system {system} is not loaded")
+        elif row[0] != COMPLETE_CONTENT:
+            self.mark_incomplete(url, f"code system {system} has {row[0]} content")
+
+    def mark_incomplete(self, url: str, reason: str):
+        print(f"ValueSet {url}: {reason}, its bindings are not checked")
+        self._connection.execute(
+            "UPDATE value_sets SET complete = 0 WHERE url = ?", (url,)
+        )
+
+    def insert_value_set_codes(self, url: str, rows: list[tuple]):
+        self._connection.execute(
+            "INSERT OR IGNORE INTO value_sets (url) VALUES (?)", (url,)
+        )
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO value_set_codes VALUES (?, ?, ?, ?)",
+            [(url, code, system or "", display) for code, system, display in rows],
+        )
+
+    def flatten_concepts(self, concepts: list[dict]):
+        for concept in concepts:
+            yield concept["code"], concept.get("display")
+            yield from self.flatten_concepts(concept.get("concept", []))
+
+    def flatten_contains(self, contains: list[dict]):
+        for item in contains:
+            if "code" in item:
+                yield item.get("system"), item["code"], item.get("display")
+            yield from self.flatten_contains(item.get("contains", []))
+
+    def has_value_set(self, url: str) -> bool:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM value_sets WHERE url = ? AND complete = 1", (url,)
+            ).fetchone()
+        return row is not None
+
+    def lookup_codes(
+        self, value_set: str, codings: list[tuple[str | None, str]]
+    ) -> list[bool]:
+        results = []
+        for start in range(0, len(codings), MAX_BATCH_SIZE):
+            batch = codings[start : start + MAX_BATCH_SIZE]
+            found = self.lookup(value_set, list({code for _, code in batch}))
+            for system, code in batch:
+                systems = found.get(code, set())
+                results.append(bool(systems) if system is None else system in systems)
+        return results
+
+    def lookup(self, value_set: str, codes: list[str]) -> dict[str, set[str]]:
+        placeholders = ", ".join("?" for _ in codes)
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT code, system FROM value_set_codes "
+                f"WHERE value_set = ? AND code IN ({placeholders})",
+                (value_set, *codes),
+            ).fetchall()
+        found: dict[str, set[str]] = {}
+        for code, system in rows:
+            found.setdefault(code, set()).add(system)
+        return found
+
+    def close(self):
+        self._connection.close()
+
+
+def package_key(package: FhirPackage) -> str:
+    # identifies the package content loaded into a store
+    return f"{getattr(package, 'name', None)}#{getattr(package, 'version', None)}"
+
+
+class RemoteTerminologyStore(CachedTerminology):
+    """Client of a TerminologyServer, so several processes share one index."""
+
+    def __init__(self, base_url: str, cache_size: int = 100_000, timeout: float = 5):
+        super().__init__(cache_size)
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self._value_sets: dict[str, bool] = {}
+
+    def has_value_set(self, url: str) -> bool:
+        if url not in self._value_sets:
+            query = urllib.parse.urlencode({"url": url})
+            request = f"{self.base_url}/ValueSet?{query}"
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                self._value_sets[url] = json.load(response).get("total", 0) > 0
+        return self._value_sets[url]
+
+    def lookup_codes(
+        self, value_set: str, codings: list[tuple[str | None, str]]
+    ) -> list[bool]:
+        body = {
+            "url": value_set,
+            "coding": [{"system": system, "code": code} for system, code in codings],
+        }
+        request = urllib.request.Request(
+            f"{self.base_url}/ValueSet/$validate-code",
+            data=json.dumps(body).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            parameters = json.load(response)["parameter"]
+        return [parameter["valueBoolean"] for parameter in parameters]
+
+
+class TerminologyRequestHandler(BaseHTTPRequestHandler):
+    # GET  /ValueSet/$validate-code?url=..&code=..[&system=..]
+    # POST /ValueSet/$validate-code {"url": .., "coding": [{"system": .., "code": ..}]}
+    # GET  /ValueSet?url=..
+    store: TerminologyStore
+
+    def do_GET(self):
+        parsed = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(parsed.query))
+        if parsed.path == "/ValueSet/$validate-code":
+            if "url" not in query or "code" not in query:
+                return self.send_json(400, {"error": "url and code are required"})
+            valid = self.store.validate_code(
+                query["url"], query["code"], query.get("system")
+            )
+            return self.send_json(200, parameters([valid]))
+        if parsed.path == "/ValueSet":
+            total = int(self.store.has_value_set(query.get("url", "")))
+            return self.send_json(200, {"resourceType": "Bundle", "total": total})
+        self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if urllib.parse.urlparse(self.path).path != "/ValueSet/$validate-code":
+            return self.send_json(404, {"error": "not found"})
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length))
+        codings = [(coding.get("system"), coding["code"]) for coding in body["coding"]]
+        results = self.store.validate_codes(body["url"], codings)
+        self.send_json(200, parameters(results))
+
+    def send_json(self, status: int, payload: dict):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/fhir+json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def parameters(results: list[bool]) -> dict:
+    return {
+        "resourceType": "Parameters",
+        "parameter": [{"name": "result", "valueBoolean": valid} for valid in results],
+    }
+
+
+def serve(store: TerminologyStore, host: str = "127.0.0.1", port: int = 8080):
+    handler = type("Handler", (TerminologyRequestHandler,), {"store": store})
+    server = ThreadingHTTPServer((host, port), handler)
+    print(f"Serving $validate-code on http://{host}:{port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db")
+    parser.add_argument("--version", default="R4")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+
+    loader = FhirPackageLoader()
+    package = loader.load_from_version(fhir_version=args.version)
+    path = args.db or c.TERMINOLOGY_DB_PATH.format(version=args.version)
+    serve(TerminologyStore.from_package(package, path=path), port=args.port)
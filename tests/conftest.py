@@ -0,0 +1,52 @@
+import os
+import sys
+import dataclasses
+
+# the modules live at the repository root and import each other by name
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import profile_map
+
+
+@dataclasses.dataclass
+class Package:
+    # stands in for fhirmodels.fhir_package.FhirPackage
+    structure_definitions: list = dataclasses.field(default_factory=list)
+    base_resource_structure_definitions: list = dataclasses.field(default_factory=list)
+    code_systems: list = dataclasses.field(default_factory=list)
+    value_sets: list = dataclasses.field(default_factory=list)
+    name: str = "test.package"
+    version: str | None = None
+
+
+def element(
+    path: str,
+    type_code: str,
+    min: int = 0,
+    max: str = "1",
+    binding: dict | None = None,
+    element_path: str | None = None,
+) -> profile_map.ProfileMapElement:
+    # element_path is the ElementDefinition.path, e.g. "Condition.onset[x]" for the
+    # profile path "onsetDateTime"; it defaults to the profile path without indexes
+    element = {
+        "path": element_path or path.replace("[i]", ""),
+        "min": min,
+        "max": max,
+        "type": [{"code": type_code}],
+    }
+    if binding:
+        element["binding"] = binding
+    return profile_map.ProfileMapElement(
+        is_primitive=type_code[0].islower(), full_path=path, element=element
+    )
+
+
+def build_pm(elements: list[profile_map.ProfileMapElement]) -> profile_map.ProfileMap:
+    by_path = {el.full_path: el for el in elements}
+    builder = profile_map.ProfileMapBuilder(package=Package())
+    return profile_map.ProfileMap(
+        by_path,
+        required=builder.get_required_paths(by_path),
+        required_choices=builder.get_required_choices(by_path),
+    )
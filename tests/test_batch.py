@@ -0,0 +1,81 @@
+import batch
+import fhir_types
+import profiling
+import terminology
+from conftest import Package, build_pm, element
+
+
+def make_validator() -> batch.BatchValidator:
+    package = Package(
+        base_resource_structure_definitions=[{"type": "Basic", "url": "profile"}]
+    )
+    validator = batch.BatchValidator(
+        package=package, terminology_store=terminology.TerminologyStore()
+    )
+    validator._profile_maps["profile"] = build_pm(
+        [
+            element("count", "integer"),
+            element("amount", "decimal"),
+            element("active", "boolean"),
+            element("onsetDateTime", "dateTime"),
+            element("contained[i]", "Resource", max="*"),
+        ]
+    )
+    return validator
+
+
+def test_find_invalid_values():
+    assert fhir_types.find_invalid_values("integer", [5, "5", 1.5, True, "x"]) == [2, 3, 4]
+    assert fhir_types.find_invalid_values("boolean", [True, 1, "true", "yes"]) == [1, 3]
+    assert fhir_types.find_invalid_values("decimal", [1.5, 2, "3.0", None]) == [3]
+    assert fhir_types.find_invalid_values("dateTime", ["2020", "2020", "x", 2020]) == [2, 3]
+
+
+def test_batch_scatters_failures_to_resources():
+    resources = [
+        {"resourceType": "Basic", "count": 5, "amount": 1.5, "active": True},
+        {"resourceType": "Basic", "count": 1.5, "onsetDateTime": "x"},
+        {"resourceType": "Basic", "onsetDateTime": "2020-01-01", "active": "yes"},
+    ]
+    issues = make_validator().validate(resources, profile={"url": "profile"})
+
+    assert issues[0] == []
+    assert [(issue.path, issue.resource_index) for issue in issues[1]] == [
+        ("count", 1),
+        ("onsetDateTime", 1),
+    ]
+    assert [issue.path for issue in issues[2]] == ["active"]
+
+
+def test_batch_reports_structure_errors_per_resource():
+    resources = [{"resourceType": "Basic", "bogus": 1}, {"resourceType": "Basic", "count": 1}]
+    issues = make_validator().validate(resources, profile={"url": "profile"})
+
+    assert [issue.message for issue in issues[0]] == [
+        "Invalid Structure: element bogus is not in the profile"
+    ]
+    assert issues[1] == []
+
+
+def test_batch_checks_contained_resources_against_their_own_profile():
+    contained = [{"resourceType": "Basic", "count": 2.5}]
+    resources = [{"resourceType": "Basic", "count": 1, "contained": contained}]
+    issues = make_validator().validate(resources, profile={"url": "profile"})
+    assert [issue.message for issue in issues[0]] == [
+        "contained[0]: Invalid Value Domain: 2.5 at count is not a valid integer"
+    ]
+
+
+def test_batch_profiler_shares_column_time_per_value():
+    profiler = profiling.Profiler()
+    resources = [
+        {"resourceType": "Basic", "count": 5},
+        {"resourceType": "Basic", "count": 6, "active": True},
+    ]
+    make_validator().validate(resources, profile={"url": "profile"}, profiler=profiler)
+    calls = {
+        (path.profile_path, path.rule): path.calls for path in profiler.hot_paths()
+    }
+    assert calls[("count", "type:integer")] == 2
+    assert calls[("active", "type:boolean")] == 1
+    assert calls[("count", "structure")] == 2
@@ -0,0 +1,82 @@
+import pytest
+
+import main
+import resource_map
+from conftest import build_pm, element
+
+
+@pytest.fixture
+def pm():
+    return build_pm(
+        [
+            element("clinicalStatus", "CodeableConcept", min=1),
+            element("clinicalStatus.coding[i]", "Coding", max="*"),
+            element("clinicalStatus.coding[i].code", "code", min=1),
+            element("bodySite[i]", "CodeableConcept"),
+            # a required choice only needs one of its types
+            element("onsetDateTime", "dateTime", min=1, element_path="Condition.onset[x]"),
+            element("onsetString", "string", min=1, element_path="Condition.onset[x]"),
+        ]
+    )
+
+
+def check(resource: dict, pm):
+    rm = resource_map.ResourceMapBuilder().build_from_dict(resource)
+    main.check_cardinality(rm, pm)
+
+
+def test_required_paths(pm):
+    assert pm.required == {
+        "": ["clinicalStatus"],
+        "clinicalStatus.coding[i]": ["clinicalStatus.coding[i].code"],
+    }
+    assert pm.required_choices == {"": {"onset[x]": ["onsetDateTime", "onsetString"]}}
+
+
+def test_counts_per_parent_instance():
+    rm = resource_map.ResourceMapBuilder().build_from_dict(
+        {
+            "resourceType": "Condition",
+            "category": [{"coding": [{}, {}]}, {"coding": [{}]}],
+            "subject": {"reference": "Patient/1"},
+        }
+    )
+    assert rm.counts == {
+        ("", "category[i]"): 2,
+        ("category[0]", "category[i].coding[i]"): 2,
+        ("category[1]", "category[i].coding[i]"): 1,
+        ("", "subject"): 1,
+        ("subject", "subject.reference"): 1,
+    }
+    assert rm["category[1].coding[0]"].profile_path == "category[i].coding[i]"
+
+
+@pytest.mark.parametrize(
+    "onset",
+    [
+        {"onsetDateTime": "2020"},
+        {"onsetString": "childhood"},
+        # a primitive with only extensions is present
+        {"_onsetString": {"extension": [{"url": "http://example.org/ext"}]}},
+    ],
+)
+def test_valid(onset, pm):
+    check({"clinicalStatus": {"coding": [{"code": "a"}, {"code": "b"}]}, **onset}, pm)
+
+
+@pytest.mark.parametrize(
+    "resource",
+    [
+        {"onsetString": "a"},
+        {
+            "clinicalStatus": {"coding": [{"code": "a"}, {"system": "s"}]},
+            "onsetString": "a",
+        },
+        {"clinicalStatus": {}, "bodySite": [{}, {}], "onsetString": "a"},
+        # a required choice element needs one of its types
+        {"clinicalStatus": {}},
+    ],
+)
+def test_invalid(resource, pm):
+    with pytest.raises(Exception, match="Invalid Cardinality"):
+        check(resource, pm)
@@ -0,0 +1,182 @@
+import pytest
+
+import main
+import resource_map
+import extension_registry
+from conftest import Package, build_pm, element
+
+SIMPLE_EXTENSION = {
+    "url": "http://example.org/ext",
+    "type": "Extension",
+    "derivation": "constraint",
+    "snapshot": {
+        "element": [
+            {"id": "Extension"},
+            {"id": "Extension.url", "fixedUri": "http://example.org/ext"},
+            {
+                "id": "Extension.value[x]",
+                "min": 1,
+                "max": "1",
+                "type": [
+                    {"code": "boolean"},
+                    {"code": "integer"},
+                    {"code": "decimal"},
+                    {"code": "dateTime"},
+                ],
+            },
+        ]
+    },
+}
+
+COMPLEX_EXTENSION = {
+    "url": "http://example.org/complex",
+    "type": "Extension",
+    "derivation": "constraint",
+    "snapshot": {
+        "element": [
+            {"id": "Extension"},
+            {"id": "Extension.extension:part", "min": 1, "max": "1"},
+            {"id": "Extension.extension:part.url", "fixedUri": "part"},
+            {
+                "id": "Extension.extension:part.value[x]",
+                "min": 1,
+                "max": "1",
+                "type": [{"code": "code"}],
+            },
+            {"id": "Extension.value[x]", "max": "0"},
+        ]
+    },
+}
+
+
+@pytest.fixture
+def registry():
+    registry = extension_registry.ExtensionRegistry()
+    registry.add(SIMPLE_EXTENSION)
+    registry.add(COMPLEX_EXTENSION)
+    return registry
+
+
+def check(resource: dict, registry):
+    rm = resource_map.ResourceMapBuilder().build_from_dict(resource)
+    main.check_extensions(rm, registry)
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        {"valueBoolean": True},
+        {"valueBoolean": False},
+        {"valueInteger": 3},
+        {"valueDecimal": 1.5},
+        {"valueDateTime": "2020-01-01"},
+    ],
+)
+def test_valid_json_values(value, registry):
+    check({"extension": [{"url": "http://example.org/ext", **value}]}, registry)
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        {"valueBoolean": "yes"},
+        {"valueInteger": 1.5},
+        {"valueInteger": True},
+        {"valueDateTime": "not a date"},
+        {"valueString": "not allowed"},
+    ],
+)
+def test_invalid_values(value, registry):
+    with pytest.raises(Exception, match="Invalid Extension"):
+        check({"extension": [{"url": "http://example.org/ext", **value}]}, registry)
+
+
+def test_missing_value(registry):
+    with pytest.raises(Exception, match="Invalid Extension"):
+        check({"extension": [{"url": "http://example.org/ext"}]}, registry)
+
+
+def test_complex_extension(registry):
+    part = {"url": "part", "valueCode": "a"}
+    check({"extension": [{"url": "http://example.org/complex", "extension": [part]}]}, registry)
+
+    part = {"url": "part", "valueCode": " a"}
+    with pytest.raises(Exception, match="Invalid Extension"):
+        check(
+            {"extension": [{"url": "http://example.org/complex", "extension": [part]}]},
+            registry,
+        )
+
+
+@pytest.mark.parametrize(
+    "parts",
+    [
+        [],
+        [{"url": "part", "valueCode": "a"}, {"url": "part", "valueCode": "b"}],
+        [{"url": "part", "valueCode": "a"}, {"url": "other", "valueCode": "b"}],
+    ],
+)
+def test_complex_extension_children(parts, registry):
+    with pytest.raises(Exception, match="Invalid Extension"):
+        check(
+            {"extension": [{"url": "http://example.org/complex", "extension": parts}]},
+            registry,
+        )
+
+
+def test_unknown_extension_is_skipped(registry):
+    check({"extension": [{"url": "http://example.org/unknown", "valueFoo": 1}]}, registry)
+
+
+@pytest.mark.parametrize(
+    "extension",
+    [
+        {"url": "http://example.org/ext", "valueBoolean": True, "bogus": "x"},
+        {"url": "http://example.org/ext", "valueBoolean": True, "bogus": ["x"]},
+        {"url": "http://example.org/unknown", "bogus": {"a": "b"}},
+    ],
+)
+def test_unknown_members(extension, registry):
+    with pytest.raises(Exception, match="Invalid Extension"):
+        check({"extension": [extension]}, registry)
+
+
+def test_registry_is_cached_per_version(monkeypatch):
+    package = Package(structure_definitions=[SIMPLE_EXTENSION])
+    monkeypatch.setattr(main, "_extension_registries", {})
+    registry = main.get_extension_registry(package, "R4")
+    assert main.get_extension_registry(package, "R4") is registry
+    assert main.get_extension_registry(package, "R5") is not registry
+    assert registry.get("http://example.org/ext") is registry.get("http://example.org/ext")
+
+
+@pytest.fixture
+def pm():
+    return build_pm([element("status", "code", min=1)])
+
+
+def test_json_primitive_extensions_belong_to_their_element(pm, registry):
+    # a primitive may carry only extensions, as in the xml <status><extension/>
+    resource = {
+        "resourceType": "Basic",
+        "_status": {
+            "id": "s1",
+            "extension": [{"url": "http://example.org/ext", "valueBoolean": True}],
+        },
+    }
+    rm = resource_map.ResourceMapBuilder().build_from_dict(resource)
+    main.check_structure(rm, pm)
+    main.check_cardinality(rm, pm)
+    main.check_extensions(rm, registry)
+
+    resource["_status"]["extension"][0]["valueBoolean"] = "yes"
+    with pytest.raises(Exception, match="Invalid Extension"):
+        check(resource, registry)
+
+
+def test_json_primitive_extensions_only_hold_id_and_extensions(pm):
+    rm = resource_map.ResourceMapBuilder().build_from_dict(
+        {"resourceType": "Basic", "status": "a", "_status": {"bogus": "x"}}
+    )
+    with pytest.raises(Exception, match="Invalid Structure"):
+        main.check_structure(rm, pm)
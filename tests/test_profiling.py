@@ -0,0 +1,73 @@
+import pytest
+
+import profiling
+
+
+@pytest.fixture
+def profiler():
+    profiler = profiling.Profiler()
+    profiler.resource_type = "Observation"
+    profiler.add("code.coding[i].code", "binding:http://example.org/vs", 0.5)
+    profiler.add("status", "type:code", 0.25, calls=2)
+    profiler.add("status", "type:code", 0.25)
+    profiler.add("", "required", 0.125)
+    profiler.resource_type = "Patient"
+    profiler.add("status", "type:code", 1.0)
+    return profiler
+
+
+def test_add_accumulates_per_resource_type_path_and_rule(profiler):
+    assert [
+        (path.resource_type, path.profile_path, path.rule, path.calls, path.seconds)
+        for path in profiler.hot_paths()
+    ] == [
+        ("Patient", "status", "type:code", 1, 1.0),
+        ("Observation", "code.coding[i].code", "binding:http://example.org/vs", 1, 0.5),
+        ("Observation", "status", "type:code", 3, 0.5),
+        ("Observation", "", "required", 1, 0.125),
+    ]
+
+
+def test_record_measures_from_start(monkeypatch):
+    profiler = profiling.Profiler()
+    monkeypatch.setattr(profiling.time, "perf_counter", lambda: 10.0)
+    start = profiler.start()
+    monkeypatch.setattr(profiling.time, "perf_counter", lambda: 10.5)
+    profiler.record("status", "structure", start)
+    profiler.record("status", "structure", start, calls=3)
+    [path] = profiler.hot_paths()
+    assert (path.calls, path.seconds) == (4, 1.0)
+
+
+def test_hot_paths_limit(profiler):
+    assert [path.seconds for path in profiler.hot_paths(limit=2)] == [1.0, 0.5]
+
+
+def test_report(profiler):
+    lines = profiler.report(limit=3).splitlines()
+    assert lines[0].split() == ["seconds", "%", "calls", "us/call", "path", "rule"]
+    assert len(lines) == 4
+    assert lines[1].split() == [
+        "1.0000",
+        "47.1",
+        "1",
+        "1000000.00",
+        "Patient.status",
+        "type:code",
+    ]
+    # the root of a resource is reported by its type alone
+    assert profiler.report().splitlines()[-1].split()[-2:] == ["Observation", "required"]
+
+
+def test_collapsed_stacks(profiler, tmp_path):
+    profiler.add("status", "invariant:a;b", 0.000002)
+    stacks = profiler.collapsed_stacks()
+    assert stacks[:2] == [
+        "Patient;status;type:code 1000000",
+        "Observation;code;coding[i];code;binding:http://example.org/vs 500000",
+    ]
+    assert stacks[-1] == "Patient;status;invariant:a,b 2"
+
+    path = tmp_path / "stacks.txt"
+    profiler.write_collapsed_stacks(str(path))
+    assert path.read_text() == "\n".join(stacks) + "\n"
@@ -0,0 +1,208 @@
+import pytest
+
+import main
+import terminology
+from conftest import Package
+
+
+STATUS_SYSTEM = "http://example.org/CodeSystem/status"
+
+CODE_SYSTEMS = [
+    {
+        "resourceType": "CodeSystem",
+        "url": STATUS_SYSTEM,
+        "content": "complete",
+        "valueSet": "http://example.org/ValueSet/status|1.0",
+        "concept": [
+            {"code": "active", "concept": [{"code": "relapse"}]},
+            {"code": "inactive"},
+        ],
+    },
+    {
+        "resourceType": "CodeSystem",
+        "url": "http://snomed.info/sct",
+        "content": "fragment",
+        "concept": [{"code": "1"}],
+    },
+]
+
+VALUE_SETS = [
+    # includes a value set that is only loaded after it
+    {
+        "resourceType": "ValueSet",
+        "url": "http://example.org/ValueSet/outer",
+        "compose": {"include": [{"valueSet": ["http://example.org/ValueSet/inner"]}]},
+    },
+    {
+        "resourceType": "ValueSet",
+        "url": "http://example.org/ValueSet/inner",
+        "compose": {
+            "include": [{"system": STATUS_SYSTEM}],
+            "exclude": [{"system": STATUS_SYSTEM, "concept": [{"code": "inactive"}]}],
+        },
+    },
+    {
+        "resourceType": "ValueSet",
+        "url": "http://example.org/ValueSet/languages",
+        "compose": {"include": [{"system": "urn:ietf:bcp:47"}]},
+    },
+    {
+        "resourceType": "ValueSet",
+        "url": "http://example.org/ValueSet/filtered",
+        "compose": {
+            "include": [
+                {
+                    "system": STATUS_SYSTEM,
+                    "filter": [{"property": "concept", "op": "is-a", "value": "active"}],
+                }
+            ]
+        },
+    },
+    {
+        "resourceType": "ValueSet",
+        "url": "http://example.org/ValueSet/uses-languages",
+        "compose": {
+            "include": [{"valueSet": ["http://example.org/ValueSet/languages"]}]
+        },
+    },
+    {
+        "resourceType": "ValueSet",
+        "url": "http://example.org/ValueSet/findings",
+        "compose": {"include": [{"system": "http://snomed.info/sct"}]},
+    },
+    {
+        "resourceType": "ValueSet",
+        "url": "http://example.org/ValueSet/expanded",
+        "expansion": {
+            "contains": [
+                {"system": "http://example.org/a", "code": "x"},
+                {"contains": [{"system": "http://example.org/b", "code": "y"}]},
+            ]
+        },
+    },
+]
+
+
+@pytest.fixture
+def store():
+    store = terminology.TerminologyStore.from_package(
+        Package(code_systems=CODE_SYSTEMS, value_sets=VALUE_SETS)
+    )
+    yield store
+    store.close()
+
+
+def test_code_system_value_set(store):
+    assert store.has_value_set("http://example.org/ValueSet/status")
+    assert store.validate_codes(
+        "http://example.org/ValueSet/status",
+        [(None, "relapse"), (STATUS_SYSTEM, "inactive"), ("http://other", "active")],
+    ) == [True, True, False]
+
+
+def test_value_set_includes_resolve_in_dependency_order(store):
+    assert store.has_value_set("http://example.org/ValueSet/outer")
+    assert store.validate_code("http://example.org/ValueSet/outer", "active")
+    assert not store.validate_code("http://example.org/ValueSet/outer", "inactive")
+
+
+def test_expansion(store):
+    assert store.validate_code("http://example.org/ValueSet/expanded", "y")
+    assert not store.validate_code(
+        "http://example.org/ValueSet/expanded", "y", "http://example.org/a"
+    )
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        # code system not in the store
+        "http://example.org/ValueSet/languages",
+        "http://example.org/ValueSet/filtered",
+        # code system that does not list all its codes
+        "http://example.org/ValueSet/findings",
+        # includes an incomplete value set
+        "http://example.org/ValueSet/uses-languages",
+        "http://example.org/ValueSet/unknown",
+    ],
+)
+def test_incomplete_value_sets_are_not_checked(store, url):
+    assert not store.has_value_set(url)
+
+
+def test_load_is_marked_and_not_repeated(tmp_path):
+    path = str(tmp_path / "terminology.db")
+    store = terminology.TerminologyStore.from_package(
+        Package(code_systems=CODE_SYSTEMS, value_sets=VALUE_SETS), path=path
+    )
+    assert store.is_loaded()
+    store.close()
+
+    # an empty package would clear the store if it were loaded again
+    store = terminology.TerminologyStore.from_package(Package(), path=path)
+    assert store.has_value_set("http://example.org/ValueSet/outer")
+    store.close()
+
+
+def test_changed_package_is_reloaded(tmp_path):
+    path = str(tmp_path / "terminology.db")
+    terminology.TerminologyStore.from_package(
+        Package(code_systems=CODE_SYSTEMS, value_sets=VALUE_SETS), path=path
+    ).close()
+
+    changed = Package(version="2.0")
+    store = terminology.TerminologyStore.from_package(changed, path=path)
+    assert store.is_loaded(changed)
+    assert not store.has_value_set("http://example.org/ValueSet/outer")
+    store.close()
+
+
+def test_load_is_checked_again_inside_the_transaction(tmp_path):
+    # a second process that saw no store before waiting for the write lock must not
+    # load the package again once the first one has finished
+    path = str(tmp_path / "terminology.db")
+    first = terminology.TerminologyStore(path=path)
+    second = terminology.TerminologyStore(path=path)
+    first.load_package(Package(code_systems=CODE_SYSTEMS, value_sets=VALUE_SETS))
+    second.load_package(Package(), reload=False)
+    assert second.has_value_set("http://example.org/ValueSet/outer")
+    first.close()
+    second.close()
+
+
+def test_failed_load_leaves_store_unloaded():
+    store = terminology.TerminologyStore()
+    with pytest.raises(KeyError):
+        store.load_package(
+            Package(code_systems=CODE_SYSTEMS, value_sets=[*VALUE_SETS, {"compose": {}}])
+        )
+    assert not store.is_loaded()
+    assert not store.has_value_set("http://example.org/ValueSet/status")
+    store.close()
+
+
+def test_cached_terminology_is_abstract():
+    with pytest.raises(TypeError):
+        terminology.CachedTerminology(cache_size=10)
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = terminology.LruCache(maxsize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+
+
+def test_store_is_shared_per_version(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "_terminology_stores", {})
+    monkeypatch.setattr(
+        main.c, "TERMINOLOGY_DB_PATH", str(tmp_path / "terminology-{version}.db")
+    )
+    package = Package(code_systems=CODE_SYSTEMS, value_sets=VALUE_SETS)
+    store = main.get_terminology_store(package, "R4")
+    assert main.get_terminology_store(package, "R4") is store
+    assert store.path == str(tmp_path / "terminology-R4.db")
+    assert main.get_terminology_store(package, "R5") is not store
@@ -0,0 +1,334 @@
+import io
+
+import pytest
+
+import main
+import profiling
+import resource_map
+import extension_registry
+import terminology
+from conftest import Package, build_pm, element
+
+STATUS_VALUE_SET = "http://example.org/ValueSet/status"
+
+
+PACKAGE = Package(
+    base_resource_structure_definitions=[
+        {"type": "Observation", "url": "observation"},
+        {"type": "Patient", "url": "patient"},
+        {"type": "Bundle", "url": "bundle"},
+    ],
+    value_sets=[
+        {
+            "url": STATUS_VALUE_SET,
+            "compose": {
+                "include": [
+                    {
+                        "system": "http://example.org/status",
+                        "concept": [{"code": "final"}, {"code": "amended"}],
+                    }
+                ]
+            },
+        }
+    ],
+)
+
+
+class Loader:
+    def load_from_version(self, fhir_version=None):
+        return PACKAGE
+
+
+OBSERVATION_PM = build_pm(
+    [
+        element(
+            "status",
+            "code",
+            min=1,
+            binding={"strength": "required", "valueSet": STATUS_VALUE_SET},
+        ),
+        element("count", "integer"),
+        element("note[i]", "Annotation", max="*"),
+        element("note[i].text", "string", min=1),
+        element("contained[i]", "Resource", max="*"),
+    ]
+)
+PATIENT_PM = build_pm(
+    [
+        element("id", "id"),
+        element("active", "boolean", min=1),
+        element("contained[i]", "Resource", max="*"),
+    ]
+)
+# an Observation profile that also requires count
+STRICT_PM = build_pm(
+    [
+        element("status", "code", min=1),
+        element("count", "integer", min=1),
+        element("contained[i]", "Resource", max="*"),
+    ]
+)
+BUNDLE_PM = build_pm(
+    [
+        element("entry[i]", "BackboneElement", max="*"),
+        element("entry[i].resource", "Resource"),
+    ]
+)
+ALL_LEVELS = [
+    main.ValidationLevel.STRUCTURE,
+    main.ValidationLevel.CARDINALITY,
+    main.ValidationLevel.TYPES,
+    main.ValidationLevel.BINDINGS,
+]
+
+
+@pytest.fixture(autouse=True)
+def package(monkeypatch):
+    monkeypatch.setattr(main, "FhirPackageLoader", Loader)
+    monkeypatch.setattr(
+        main,
+        "_profile_maps",
+        {
+            ("R4", "observation"): OBSERVATION_PM,
+            ("R4", "patient"): PATIENT_PM,
+            ("R4", "bundle"): BUNDLE_PM,
+            ("R4", "strict"): STRICT_PM,
+        },
+    )
+
+
+@pytest.fixture(scope="module")
+def store():
+    store = terminology.TerminologyStore.from_package(PACKAGE)
+    yield store
+    store.close()
+
+
+def validate(resource: dict, store, **kwargs) -> main.ValidationResult:
+    return main.validate(
+        {"resourceType": "Observation", **resource},
+        profile={"url": "observation"},
+        registry=extension_registry.ExtensionRegistry(),
+        terminology_store=store,
+        **kwargs,
+    )
+
+
+def test_valid_resource_runs_every_implemented_level(store):
+    result = validate({"status": "final", "count": 2}, store)
+    assert result.valid
+    assert result.levels_run == ALL_LEVELS
+    assert result.deferred_levels == []
+
+
+@pytest.mark.parametrize(
+    "level, levels_run",
+    [
+        (main.ValidationLevel.STRUCTURE, ALL_LEVELS[:1]),
+        (main.ValidationLevel.TYPES, ALL_LEVELS[:3]),
+        (main.ValidationLevel.INVARIANTS, ALL_LEVELS),
+    ],
+)
+def test_levels_are_cumulative(store, level, levels_run):
+    assert validate({"status": "final"}, store, level=level).levels_run == levels_run
+
+
+def test_unknown_element_is_a_structure_issue_at_any_level(store):
+    result = validate(
+        {"status": "final", "bogus": 1}, store, level=main.ValidationLevel.TYPES
+    )
+    assert result.levels_run == ALL_LEVELS[:1]
+    assert result.issues == ["Invalid Structure: element bogus is not in the profile"]
+
+
+def test_type_and_binding_checks_skip_unknown_paths(store):
+    rm = resource_map.ResourceMapBuilder().build_from_dict(
+        {"resourceType": "Observation", "status": "final", "bogus": 1}
+    )
+    main.check_value_domains(rm, OBSERVATION_PM)
+    main.check_coding_bindings(rm, OBSERVATION_PM, store)
+
+
+def test_issues_name_path_and_detail(store):
+    result = validate({"status": "draft", "count": "x", "note": [{}]}, store)
+    assert result.levels_run == ALL_LEVELS
+    assert result.issues == [
+        "Invalid Cardinality: expected 1 but found 0 for element note[i].text in note[0]",
+        "Invalid Value Domain: 'x' at count is not a valid integer",
+        f"Invalid Coding Binding: draft at status is not in {STATUS_VALUE_SET}",
+    ]
+
+
+def test_fail_fast_stops_at_first_issue(store):
+    result = validate({"status": "draft", "count": "x"}, store, fail_fast=True)
+    assert result.levels_run == ALL_LEVELS[:3]
+    assert len(result.issues) == 1
+
+
+def test_element_budget_defers_levels(store):
+    # the resource map has two elements, so the budget covers two levels
+    result = validate(
+        {"status": "final", "count": 2},
+        store,
+        budget=main.ValidationBudget(max_elements=4),
+    )
+    assert result.levels_run == ALL_LEVELS[:2]
+    assert result.deferred_levels == ALL_LEVELS[2:]
+
+
+def test_deferred_levels_can_be_backfilled(store):
+    deferred = validate(
+        {"status": "draft", "count": 2},
+        store,
+        budget=main.ValidationBudget(max_elements=4),
+    ).deferred_levels
+    result = validate({"status": "draft", "count": 2}, store, levels=deferred)
+    assert result.levels_run == ALL_LEVELS[2:]
+    assert result.issues == [
+        f"Invalid Coding Binding: draft at status is not in {STATUS_VALUE_SET}"
+    ]
+
+
+OBSERVATION_XML = """<Observation xmlns="http://hl7.org/fhir">
+  <status value="draft"/>
+  <count value="x"/>
+</Observation>"""
+
+
+def test_validate_xml_reports_issues_like_validate(store):
+    result = main.validate_xml(
+        io.BytesIO(OBSERVATION_XML.encode()),
+        registry=extension_registry.ExtensionRegistry(),
+        terminology_store=store,
+        level=main.ValidationLevel.TYPES,
+    )
+    assert result.levels_run == ALL_LEVELS[:3]
+    assert result.issues == ["Invalid Value Domain: 'x' at count is not a valid integer"]
+    assert result.pm is OBSERVATION_PM
+
+
+def test_validate_xml_fail_fast_checks_structure_while_parsing(store):
+    xml = """<Observation xmlns="http://hl7.org/fhir">
+      <status value="final"/>
+      <bogus value="1"/>
+    </Observation>"""
+    result = main.validate_xml(
+        io.BytesIO(xml.encode()),
+        registry=extension_registry.ExtensionRegistry(),
+        terminology_store=store,
+        fail_fast=True,
+    )
+    assert result.rm is None
+    assert result.pm is OBSERVATION_PM
+    assert result.levels_run == ALL_LEVELS[:1]
+    assert result.issues == ["Invalid Structure: element bogus is not in the profile"]
+
+
+def test_validate_xml_bundle_yields_a_result_per_entry(store):
+    bundle = f"""<Bundle xmlns="http://hl7.org/fhir">
+      <entry><resource>{OBSERVATION_XML}</resource></entry>
+      <entry><resource><Observation><status value="final"/></Observation></resource></entry>
+    </Bundle>"""
+    results = list(
+        main.validate_xml_bundle(
+            io.BytesIO(bundle.encode()),
+            registry=extension_registry.ExtensionRegistry(),
+            terminology_store=store,
+            budget=main.ValidationBudget(max_elements=2),
+        )
+    )
+    assert [result.issues for result in results] == [[], []]
+    assert [result.levels_run for result in results] == [ALL_LEVELS[:1], ALL_LEVELS[:2]]
+
+
+def test_contained_resources_are_checked_against_their_own_profile(store):
+    patient = {"resourceType": "Patient", "id": "p", "active": True}
+    result = validate({"status": "final", "contained": [patient]}, store)
+    assert result.valid
+
+    patient = {"resourceType": "Patient", "active": "yes", "contained": [{"id": "x"}]}
+    result = validate({"status": "final", "contained": [patient]}, store)
+    assert result.issues == [
+        "Invalid Structure: missing resourceType at contained[0].contained[0]"
+    ]
+
+    patient = {"resourceType": "Patient", "active": "yes", "status": "final"}
+    result = validate({"status": "final", "contained": [patient]}, store, fail_fast=True)
+    assert result.issues == [
+        "contained[0]: Invalid Structure: element status is not in the profile"
+    ]
+
+    patient = {"resourceType": "Patient", "active": "yes"}
+    result = validate({"status": "final", "contained": [patient]}, store)
+    assert result.issues == [
+        "contained[0]: Invalid Value Domain: 'yes' at active is not a valid boolean"
+    ]
+
+
+def test_contained_resources_in_xml(store):
+    xml = """<Observation xmlns="http://hl7.org/fhir">
+      <status value="final"/>
+      <contained><Patient><id value="p"/><active value="maybe"/></Patient></contained>
+    </Observation>"""
+    result = main.validate_xml(
+        io.BytesIO(xml.encode()),
+        registry=extension_registry.ExtensionRegistry(),
+        terminology_store=store,
+    )
+    assert result.issues == [
+        "contained[0]: Invalid Value Domain: 'maybe' at active is not a valid boolean"
+    ]
+
+
+def test_xml_profile_maps_come_from_the_process_cache(store, monkeypatch):
+    def fail(profile):
+        raise AssertionError("profile map rebuilt")
+
+    monkeypatch.setattr(main.profile_map.ProfileMapBuilder, "build_from_profile", fail)
+    result = main.validate_xml(
+        io.BytesIO(OBSERVATION_XML.encode()),
+        registry=extension_registry.ExtensionRegistry(),
+        terminology_store=store,
+    )
+    assert result.pm is OBSERVATION_PM
+
+
+def test_explicit_profile_applies_to_the_root_only():
+    cache = main.ProfileMapCache(PACKAGE, "R4", profile={"url": "strict"})
+    assert cache("Observation") is STRICT_PM
+    assert cache("Patient") is PATIENT_PM
+    assert cache("Observation") is STRICT_PM
+    assert cache.root is STRICT_PM
+
+
+def test_validate_xml_checks_contained_resources_against_their_own_type(store):
+    xml = """<Observation xmlns="http://hl7.org/fhir">
+      <status value="final"/>
+      <contained><Patient><active value="true"/></Patient></contained>
+    </Observation>"""
+    result = main.validate_xml(
+        io.BytesIO(xml.encode()),
+        profile={"url": "strict"},
+        registry=extension_registry.ExtensionRegistry(),
+        terminology_store=store,
+    )
+    assert result.pm is STRICT_PM
+    assert result.issues == [
+        "Invalid Cardinality: expected 1 but found 0 for element count in the resource"
+    ]
+
+
+def test_profiler_attributes_checks_to_profile_paths(store):
+    profiler = profiling.Profiler()
+    validate({"status": "final", "count": 2}, store, profiler=profiler)
+    rules = {
+        (path.resource_type, path.profile_path, path.rule)
+        for path in profiler.hot_paths()
+    }
+    assert {
+        ("Observation", "status", "structure"),
+        ("Observation", "count", "structure"),
+        ("Observation", "status", "type:code"),
+        ("Observation", "count", "type:integer"),
+        ("Observation", "status", f"binding:{STATUS_VALUE_SET}"),
+    } <= rules
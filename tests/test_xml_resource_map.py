@@ -0,0 +1,149 @@
+import io
+
+import pytest
+
+import profile_map
+import resource_map
+from conftest import build_pm, element
+
+
+def typed_pm(elements: dict[str, str]) -> profile_map.ProfileMap:
+    return build_pm([element(path, type_code) for path, type_code in elements.items()])
+
+
+PROFILE_MAPS = {
+    "Procedure": typed_pm(
+        {
+            "id": "id",
+            "outcome": "CodeableConcept",
+            "outcome.coding[i]": "Coding",
+            "outcome.coding[i].code": "code",
+            "outcome.text": "string",
+            "contained[i]": "Resource",
+        }
+    ),
+    "Patient": typed_pm(
+        {
+            "id": "id",
+            "name[i]": "HumanName",
+            "name[i].family": "string",
+        }
+    ),
+    "Bundle": typed_pm(
+        {
+            "id": "id",
+            "type": "code",
+            "entry[i]": "BackboneElement",
+            "entry[i].fullUrl": "uri",
+            "entry[i].resource": "Resource",
+        }
+    ),
+}
+
+
+def parse(xml: str) -> resource_map.ResourceMap:
+    return resource_map.ResourceMapBuilder().build_from_xml(
+        io.BytesIO(xml.encode()), PROFILE_MAPS.get
+    )
+
+
+def test_complex_element_is_not_a_resource_wrapper():
+    rm = parse(
+        """<Procedure xmlns="http://hl7.org/fhir">
+          <outcome>
+            <coding><code value="385669000"/></coding>
+            <text value="Successful"/>
+          </outcome>
+        </Procedure>"""
+    )
+    assert sorted(rm.map) == [
+        "outcome",
+        "outcome.coding[0]",
+        "outcome.coding[0].code",
+        "outcome.text",
+    ]
+    assert rm.map["outcome.text"].value == "Successful"
+
+
+def test_contained_resources_match_json():
+    rm = parse(
+        """<Procedure xmlns="http://hl7.org/fhir">
+          <id value="p1"/>
+          <contained>
+            <Patient>
+              <id value="pat"/>
+              <name><family value="Chalmers"/></name>
+              <name><family value="Windsor"/></name>
+            </Patient>
+          </contained>
+        </Procedure>"""
+    )
+    expected = resource_map.ResourceMapBuilder().build_from_dict(
+        {
+            "resourceType": "Procedure",
+            "id": "p1",
+            "contained": [
+                {
+                    "resourceType": "Patient",
+                    "id": "pat",
+                    "name": [{"family": "Chalmers"}, {"family": "Windsor"}],
+                }
+            ],
+        }
+    )
+    assert rm.map == {
+        path: el for path, el in expected.map.items() if path != "resourceType"
+    }
+    assert rm.map["contained[0].name[1].family"].profile_path == (
+        "contained[i].name[i].family"
+    )
+
+
+BUNDLE_XML = """<Bundle xmlns="http://hl7.org/fhir">
+  <id value="b1"/>
+  <type value="collection"/>
+  <entry>
+    <fullUrl value="urn:uuid:1"/>
+    <resource><Patient><id value="a"/></Patient></resource>
+  </entry>
+  <entry>
+    <fullUrl value="urn:uuid:2"/>
+    <resource>
+      <Procedure>
+        <id value="b"/>
+        <outcome><text value="Successful"/></outcome>
+      </Procedure>
+    </resource>
+  </entry>
+</Bundle>"""
+
+
+def test_bundle_entries_are_split_without_bundle_content():
+    entries = list(
+        resource_map.ResourceMapBuilder().iter_bundle_entries_from_xml(
+            io.BytesIO(BUNDLE_XML.encode()), PROFILE_MAPS.get
+        )
+    )
+    assert [(resource_type, sorted(rm.map)) for resource_type, rm in entries] == [
+        ("Patient", ["id"]),
+        ("Procedure", ["id", "outcome", "outcome.text"]),
+    ]
+    assert entries[0][1].counts == {("", "id"): 1}
+
+
+def test_bundle_parsed_whole_keeps_entries_inline():
+    rm = parse(BUNDLE_XML)
+    assert rm.map["entry[1].resource.resourceType"].value == "Procedure"
+    assert rm.map["entry[1].resource.outcome.text"].profile_path == (
+        "entry[i].resource.outcome.text"
+    )
+
+
+def test_split_requires_bundle_root():
+    with pytest.raises(Exception, match="Invalid Bundle"):
+        list(
+            resource_map.ResourceMapBuilder().iter_bundle_entries_from_xml(
+                io.BytesIO(b'<Patient xmlns="http://hl7.org/fhir"/>'),
+                PROFILE_MAPS.get,
+            )
+        )